@@ -0,0 +1,191 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+
+# Seconds between two collections of the blobs no user file references anymore
+GC_INTERVAL = 600
+
+# Seconds an unreferenced blob is kept after it was written or reused, the lock only covers this process
+# and during a restart another server process may be about to link the blob
+GC_GRACE = 60
+
+
+class BlobStore():
+    """ Content-addressed storage shared by all users
+
+        Every distinct file content is stored exactly once under root/blobs/<aa>/<digest>.
+        User files are hard links to their blob, so the user path is the blob reference,
+        the link count of the blob is its reference count and reading a user file needs no lookup.
+        Writing content that is already stored only creates a new link (metadata only).
+
+    Args:
+        root (str): The directory holding the blobs, must be on the same filesystem as the user directories
+        gc_interval (float): Seconds between garbage collections in a background thread (default: None - only collect_garbage)
+        grace (float): Seconds an unreferenced blob is kept after it was written or reused (default: GC_GRACE)
+
+    Attributes:
+        root (str): The directory holding the blobs
+        temp_directory (str): Where blobs and links are created before they are renamed into place
+        lock (Lock): Serializes linking and garbage collection so a blob is never collected while being linked
+    """
+
+    def __init__(self, root=os.path.join("root", "blobs"), gc_interval=None, grace=GC_GRACE):
+        self.root = root
+        self.temp_directory = os.path.join(root, ".tmp")
+        self.grace = grace
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.temp_directory):
+            os.makedirs(self.temp_directory)
+
+        # Every rewrite or removal of a user file can leave its old blob unreferenced
+        if gc_interval is not None:
+            threading.Thread(target=self.collect_periodically, args=[gc_interval], daemon=True).start()
+
+    def blob_path(self, digest):
+        """ Get the path of a blob, blobs are fanned out by the first two characters of their digest
+
+        Args:
+            digest (str): The sha256 hex digest of the content
+
+        Returns:
+            str: The path of the blob
+
+        >>> BlobStore().blob_path("ab12") == os.path.join("root", "blobs", "ab", "ab12")
+        True
+        """
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data):
+        """ Store content if it is not stored yet
+
+        Args:
+            data (bytes): The content to store
+
+        Returns:
+            str: The digest of the content
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+
+        # An unreferenced blob that is reused is kept for another grace period
+        try:
+            if os.stat(path).st_nlink <= 1:
+                os.utime(path)
+            return digest
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so a blob is never seen half written
+        fd, tmp_path = tempfile.mkstemp(dir=self.temp_directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        return digest
+
+    def store(self, path, data):
+        """ Store content and point the given user path at it
+
+        Args:
+            path (str): The user path to write
+            data (bytes): The new content of the file
+
+        Returns:
+            str: The digest of the content
+
+        >>> store = BlobStore()
+        >>> os.makedirs("root/usr/john", exist_ok=True)
+        >>> digest = store.store("root/usr/john/a", b"same content")
+        >>> store.store("root/usr/john/b", b"same content") == digest
+        True
+        >>> store.references(digest)
+        2
+        >>> os.remove("root/usr/john/a"); os.remove("root/usr/john/b")
+        >>> store.collect_garbage(grace=0)
+        1
+        """
+        # The name is unique to the thread, which links one file at a time, and no user can name a file here
+        tmp_path = os.path.join(self.temp_directory, f"link-{os.getpid()}-{threading.get_ident()}")
+
+        with self.lock:
+            for attempt in range(2):
+                digest = self.put(data)
+                blob = self.blob_path(digest)
+
+                # Writing the same content again is a no-op
+                if os.path.exists(path) and os.path.samefile(path, blob):
+                    return digest
+
+                # Link and rename over the target so readers see either the old or the new content
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                try:
+                    os.link(blob, tmp_path)
+                    break
+                except FileNotFoundError:
+                    # Another server process collected the blob after put, it is written again
+                    if attempt == 1:
+                        raise
+
+            os.replace(tmp_path, path)
+
+        return digest
+
+    def references(self, digest):
+        """ Get the number of user files referencing a blob
+
+        Args:
+            digest (str): The digest of the blob
+
+        Returns:
+            int: The number of references
+        """
+        return os.stat(self.blob_path(digest)).st_nlink - 1
+
+    def collect_garbage(self, grace=None):
+        """ Remove all blobs that are no longer referenced by any user file and were not written or reused recently
+
+        Args:
+            grace (float): Seconds an unreferenced blob is kept after it was written or reused (default: None - self.grace)
+
+        Returns:
+            int: The number of blobs removed
+        """
+        removed = 0
+        deadline = time.time() - (self.grace if grace is None else grace)
+
+        with self.lock:
+            for fan_out in os.scandir(self.root):
+                if not fan_out.is_dir() or fan_out.name.startswith("."):
+                    continue
+
+                for blob in os.scandir(fan_out.path):
+                    stat = blob.stat()
+                    if stat.st_nlink <= 1 and stat.st_mtime <= deadline:
+                        os.remove(blob.path)
+                        removed += 1
+
+        return removed
+
+    def collect_periodically(self, interval):
+        """ Remove the unreferenced blobs every interval seconds, runs in its own thread
+
+        Args:
+            interval (float): Seconds between two collections
+
+        >>> store = BlobStore(tempfile.mkdtemp(), gc_interval=0.05, grace=0)
+        >>> store.put(b"orphan") and time.sleep(0.2)
+        >>> os.path.exists(store.blob_path(hashlib.sha256(b"orphan").hexdigest()))
+        False
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                self.collect_garbage()
+            except OSError as e:
+                print("Blob garbage collection failed: " + str(e))
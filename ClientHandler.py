@@ -1,8 +1,24 @@
+import os
+import select
+import socket
+import threading
 from FileManager import FileManager
-from Users import Users
+from Users import Users, check_username
+from EventBus import Watcher
+import Protocol
 
 DEBUG = True
 
+# Commands are read with a single recv, so a command must be shorter than this many bytes.
+# This limits write_range to about 1000 bytes of data per command, larger uploads take several commands.
+MAX_COMMAND_SIZE = 2048
+
+# Seconds to wait for the rest of a command that was too long, it is read and discarded
+DRAIN_TIMEOUT = 0.1
+
+# Seconds between checks of an idle session whether the server asked it to stop
+STOP_INTERVAL = 0.5
+
 def debug(msg):
     """
         Prints a debug message if DEBUG is True
@@ -19,90 +35,259 @@ class ClientHandler():
 
     Args:
         conn (socket): The socket connection to the client
-        DB (Users): The database of users (default: Users() - creates a new database instance if not provided):
+        DB (Users): The database of users (default: None - creates a new database instance, loaded in the background):
         conn (socket): The socket connection to the client 
         FileManager (FileManager): The file manager for the current user (initialized when the user logs in)
         user (User): The current logged in user user
-        commands (dict): The commands that can be executed by the client including their help messages, handlers and required/optional arguments
+        blob_store (BlobStore): The shared content-addressed store passed to the file manager (default: None - deduplication disabled)
+        compression (str): The codec stored files are compressed with, passed to the file manager (default: None - files are stored uncompressed)
+        response_compression (int): The zlib level responses are compressed with, set by the 'compress' command (None until negotiated)
+        framed (bool): Whether responses are sent as frames, enabled once compression is negotiated
+        watcher (Watcher): Pushes the changes of the watched path to the client, None if nothing is watched
+        send_lock (RLock): Keeps responses and pushed events from interleaving on the connection
+        limiter (RateLimiter): The rate limits shared by all connections (default: None - commands are not limited)
+        connection_limits (Limits): The rate limits of this connection, created when the connection is handled
+        stopping (bool): Whether the server asked the session to end after the command in progress
+        journal (Journal): Records the commands run for replay and recovery (default: None - commands are not recorded)
+        session (int): The number of the session in the journal, None if commands are not recorded
+        storage (Storage): The storage roots the users' directories are placed on (default: None - all users are below root/usr)
+        storage_user (str): The user whose directory the session holds on to so it is not moved, None if not logged in
+        profiler (Profiler): Profiles the commands an admin asked for with 'profile' (default: None - profiling is disabled)
+        admins (frozenset): The usernames allowed to run admin commands, they can't be registered (default: none)
+        admin (bool): Whether the session logged in as one of the admins
+        commands (dict): The commands that can be executed by the client including their help messages, handler names and required/optional arguments, shared by all sessions
 
     """
-    def __init__(self, conn, DB=Users()):
+    # The attributes of a session, without a __dict__ so each connection takes as little memory as possible
+    __slots__ = ("conn", "DB", "blob_store", "compression", "response_compression", "framed", "watcher",
+                 "send_lock", "limiter", "connection_limits", "stopping", "FileManager", "user",
+                 "journal", "session", "storage", "storage_user", "profiler",
+                 "admins", "admin")
+
+    # Shared by all sessions, the handler of each command is looked up by name on the session
+    commands = {
+        "exit": {
+            "help": "Exit the program",
+            "method": "exit",
+            "arguments": []
+        },
+        "help": {
+            "help": "Shows this message",
+            "method": "help",
+            "arguments": []
+        },
+
+        "register": {
+            "help": "Register a new user",
+            "method": "register",
+            "arguments": [{
+                "name": "username", 'optional': False, "description": "The username for the new user"},
+                {
+                "name": "password", 'optional': False,
+                "description": "The password for the new user"
+            }],
+
+        },
+        "login": {
+            "help": "Login to your account",
+            "method": "login",
+            "arguments": [{"name": "username", 'optional': False, "description": ""},
+                          {"name": "password", 'optional': False, "description": ""}],
+
+
+        },
+        "list": {
+            "help": "List all files in the current directory",
+            "method": "list",
+            "arguments": []
+        },
+        "change_folder": {
+            "help": "Change the current working directory",
+            "method": "change_folder",
+            "arguments": [{"name": "folder_name", 'optional': False,
+                           "description": "The name of the folder you want to change to"
+                           }],
+        },
+        "read_file": {
+            "help": "Reads 100 characters of the file from the last read position, starting from 0 for the first read of a new file",
+            "method": "read_file",
+            "arguments": [{"name": "file_name", 'optional': True,
+                           "description": "The name of the file to read. If not provided the currently open file's read offset will be reset"
+                           }],
+        },
+        "write_file": {
+            "help": "Write content to a given file. The file will be created if it does not already exist",
+            "method": "write_file",
+            "arguments": [
+                {"name": "file_name", 'optional': False,
+                    "description": "The name of the file to write to"},
+                {"name": "input", 'optional': True,
+                    "description": "The content to write to the file. If not provided, the existing file will be cleared"}
+            ],
+        },
+        "read_range": {
+            "help": "Read a byte range of a file as hex, independent of read_file so downloads can be resumed or split",
+            "method": "read_range",
+            "arguments": [
+                {"name": "file_name", 'optional': False,
+                    "description": "The name of the file to read"},
+                {"name": "offset", 'optional': False,
+                    "description": "The byte offset to start reading at"},
+                {"name": "length", 'optional': False,
+                    "description": "The number of bytes to read"}
+            ],
+        },
+        "write_range": {
+            "help": ("Write hex encoded bytes at an offset of a file, the file will be created if it does not already exist. "
+                     f"The command must be shorter than {MAX_COMMAND_SIZE} bytes, write larger data in several commands. "
+                     "The offset can be at most 1 MiB past the end of the file. Compressed files are only written "
+                     "cheaply at their end, and deduplicated files are rewritten as a whole on every write, so large "
+                     "uploads out of order are only practical for plain files"),
+            "method": "write_range",
+            "arguments": [
+                {"name": "file_name", 'optional': False,
+                    "description": "The name of the file to write to"},
+                {"name": "offset", 'optional': False,
+                    "description": "The byte offset to write at"},
+                {"name": "data", 'optional': False,
+                    "description": "The bytes to write encoded as hex"}
+            ],
+        },
+        "checksum": {
+            "help": "Get the CRC32 of each chunk of a file and of the whole file to verify or resume a transfer",
+            "method": "checksum",
+            "arguments": [
+                {"name": "file_name", 'optional': False,
+                    "description": "The name of the file"},
+                {"name": "chunk_size", 'optional': True,
+                    "description": "The number of bytes covered by each chunk checksum (default: 65536)"}
+            ],
+        },
+        "create_folder": {
+            "help": "Create a new folder in the current directory",
+            "method": "create_folder",
+            "arguments": [
+                {"name": "folder_name", 'optional': False,
+                    "description": "The name of the new folder to create"}
+            ],
+
+        },
+        "search": {
+            "help": "Search the files in the current directory and its sub folders, results are streamed back",
+            "method": "search",
+            "arguments": [
+                {"name": "pattern", 'optional': False,
+                    "description": "The pattern the file names must match, e.g. *.log"},
+                {"name": "text", 'optional': True,
+                    "description": "The words the lines must contain. If not provided, only names are matched"}
+            ],
+        },
+        "tree": {
+            "help": "List a folder and all its sub folders, the listing is streamed back",
+            "method": "tree",
+            "arguments": [
+                {"name": "folder_name", 'optional': True,
+                    "description": "The folder to list. If not provided, the current directory is listed"}
+            ],
+        },
+        "copy": {
+            "help": "Copy a file or a folder with all its contents, the progress is streamed back",
+            "method": "copy",
+            "arguments": [
+                {"name": "source", 'optional': False,
+                    "description": "The file or folder to copy"},
+                {"name": "destination", 'optional': False,
+                    "description": "The new path, or an existing folder to copy into"}
+            ],
+        },
+        "move": {
+            "help": "Move or rename a file or a folder with all its contents",
+            "method": "move",
+            "arguments": [
+                {"name": "source", 'optional': False,
+                    "description": "The file or folder to move"},
+                {"name": "destination", 'optional': False,
+                    "description": "The new path, or an existing folder to move into"}
+            ],
+        },
+        "remove": {
+            "help": "Remove a file or a folder with all its contents, the progress is streamed back",
+            "method": "remove",
+            "arguments": [
+                {"name": "name", 'optional': False,
+                    "description": "The file or folder to remove"}
+            ],
+        },
+        "watch": {
+            "help": "Push changes of a file or folder and everything below it to the client, requires 'compress' first",
+            "method": "watch",
+            "arguments": [
+                {"name": "name", 'optional': True,
+                    "description": "The file or folder to watch. If not provided, the current directory is watched"}
+            ],
+        },
+        "unwatch": {
+            "help": "Stop pushing changes to the client",
+            "method": "unwatch",
+            "arguments": []
+        },
+        "limits": {
+            "help": "Show the rate limits and the tokens left for every user and connection (admin only)",
+            "method": "limits",
+            "arguments": []
+        },
+        "profile": {
+            "help": "Profile commands while the server keeps serving, the results are written to the profiles folder (admin only)",
+            "method": "profile",
+            "arguments": [
+                {"name": "action", 'optional': False,
+                    "description": "'cprofile' or 'sample' to start profiling, 'stop' to stop and write the results, 'status'"},
+                {"name": "seconds", 'optional': True,
+                    "description": "How long to profile before the results are written (default: 60)"},
+                {"name": "user", 'optional': True,
+                    "description": "Only profile the commands of this user, * for all users (default: *)"},
+                {"name": "command", 'optional': True,
+                    "description": "Only profile this command, e.g. list (default: all commands)"}
+            ],
+        },
+        "rebalance": {
+            "help": "Move the users that are not logged in to the storage root they belong to, the progress is streamed back (admin only)",
+            "method": "rebalance",
+            "arguments": []
+        },
+        "compress": {
+            "help": "Compress responses, every response after this one is sent as a length prefixed frame",
+            "method": "compress",
+            "arguments": [
+                {"name": "level", 'optional': True,
+                    "description": "The zlib compression level from 1 to 9 (default: 6)"}
+            ],
+        }
+
+    }
+
+    def __init__(self, conn, DB=None, blob_store=None, compression=None, limiter=None, journal=None, storage=None,
+                 profiler=None, admins=frozenset()):
         self.conn = conn
-        self.DB = DB
+        self.DB = DB if DB is not None else Users(background=True)
+        self.blob_store = blob_store
+        self.compression = compression
+        self.response_compression = None
+        self.framed = False
+        self.watcher = None
+        self.send_lock = threading.RLock()
+        self.limiter = limiter
+        self.connection_limits = None
+        self.stopping = False
         self.FileManager = None
         self.user = None
-
-        self.commands = {
-            "exit": {
-                "help": "Exit the program",
-                "method": self.exit,
-                "arguments": []
-            },
-            "help": {
-                "help": "Shows this message",
-                "method": self.help,
-                "arguments": []
-            },
-
-            "register": {
-                "help": "Register a new user",
-                "method": self.register,
-                "arguments": [{
-                    "name": "username", 'optional': False, "description": "The username for the new user"},
-                    {
-                    "name": "password", 'optional': False,
-                    "description": "The password for the new user"
-                }],
-
-            },
-            "login": {
-                "help": "Login to your account",
-                "method": self.login,
-                "arguments": [{"name": "username", 'optional': False, "description": ""},
-                              {"name": "password", 'optional': False, "description": ""}],
-
-
-            },
-            "list": {
-                "help": "List all files in the current directory",
-                "method": self.list,
-                "arguments": []
-            },
-            "change_folder": {
-                "help": "Change the current working directory",
-                "method": self.change_folder,
-                "arguments": [{"name": "folder_name", 'optional': False,
-                               "description": "The name of the folder you want to change to"
-                               }],
-            },
-            "read_file": {
-                "help": "Reads 100 characters of the file from the last read position, starting from 0 for the first read of a new file",
-                "method": self.read_file,
-                "arguments": [{"name": "file_name", 'optional': True,
-                               "description": "The name of the file to read. If not provided the currently open file's read offset will be reset"
-                               }],
-            },
-            "write_file": {
-                "help": "Write content to a given file. The file will be created if it does not already exist",
-                "method": self.write_file,
-                "arguments": [
-                    {"name": "file_name", 'optional': False,
-                        "description": "The name of the file to write to"},
-                    {"name": "input", 'optional': True,
-                        "description": "The content to write to the file. If not provided, the existing file will be cleared"}
-                ],
-            },
-            "create_folder": {
-                "help": "Create a new folder in the current directory",
-                "method": self.create_folder,
-                "arguments": [
-                    {"name": "folder_name", 'optional': False,
-                        "description": "The name of the new folder to create"}
-                ],
-
-            }
-
-        }
+        self.journal = journal
+        self.session = journal.session() if journal is not None else None
+        self.storage = storage
+        self.storage_user = None
+        self.profiler = profiler
+        self.admins = admins
+        self.admin = False
 
     def handle(self, conn, addr):
         """Generic handler for each command sent to the server
@@ -115,30 +300,106 @@ class ClientHandler():
         """
         conn.send(b"Welcome to the server! Please enter your command")
 
+        if self.limiter is not None:
+            self.connection_limits = self.limiter.connect(f"{addr[0]}:{addr[1]}")
+
         while True:
             try:
                 # receive command from client
-                command = conn.recv(2048).decode().lower()
+                command = self.receive_command(conn)
 
+                # Never run part of a command, and never read its rest as the next command
+                if command is None:
+                    self.send(f"Error: The command must be shorter than {MAX_COMMAND_SIZE} bytes")
+                    continue
+
+                # The client disconnected, or the server asked the idle session to stop because it is shutting down
                 if not command:
-                    conn.send(b"No command was entered, try again")
+                    break
+
+                # Delay the command or reject it when over the limits
+                if self.limiter is not None:
+                    try:
+                        self.limiter.admit(self.rate_limits(), len(command))
+                    except Exception as e:
+                        self.send("Error: " + str(e))
+                        continue
 
                 # Get response from handler method
                 response = self.validated_command_execution(command)
 
-                # send back response
-                conn.send(response.encode("UTF-8"))
+                # The exit command already closed the connection
+                if response is None:
+                    break
+
+                # send back response, streamed responses are sent piece by piece as they are produced
+                if isinstance(response, str):
+                    self.send(response)
+                    self.charge(len(response))
+                else:
+                    self.send_stream(response)
 
             except Exception as e:
                 debug(e)
                 try:
-                    conn.send(b"Server error occurred")
+                    self.send("Server error occurred")
                 except IOError:  # client disconnected so can't send error message
                     break
 
+        if self.stopping:
+            try:
+                self.send("Server is shutting down, goodbye")
+            except IOError:
+                pass
+
+        self.unwatch([])
+        if self.FileManager is not None:
+            self.FileManager.close()
+        self.release_storage()
+        if self.limiter is not None:
+            self.limiter.disconnect(f"{addr[0]}:{addr[1]}")
+        # An empty command marks the end of the session
+        if self.journal is not None:
+            self.journal.record(self.session, "")
         conn.close()
         print("Client disconnected:" + addr[0])
 
+    def receive_command(self, conn):
+        """Receive the next command, a command filling the whole buffer may have been cut and is discarded
+
+        Args:
+            conn (socket): The socket connection to the client
+
+        Returns:
+            str: The command, empty if the client disconnected or the server asked the session to stop,
+                 None if the command was too long
+        """
+
+        # Wait for the next command without blocking in recv, so a stop request is noticed while idle.
+        # Decrypted bytes an SSLSocket already holds don't make the socket readable, so they are checked first
+        while not (getattr(conn, "pending", None) and conn.pending()):
+            if self.stopping:
+                return ""
+            if select.select([conn], [], [], STOP_INTERVAL)[0]:
+                break
+
+        data = conn.recv(MAX_COMMAND_SIZE)
+        if len(data) < MAX_COMMAND_SIZE:
+            return data.decode().lower()
+
+        # Read the rest of the command until the client waits for the response
+        timeout = conn.gettimeout()
+        conn.settimeout(DRAIN_TIMEOUT)
+        try:
+            while conn.recv(MAX_COMMAND_SIZE):
+                pass
+        except socket.timeout:
+            pass
+        finally:
+            conn.settimeout(timeout)
+
+        return None
+
     def validated_command_execution(self, command):
         """Validates the command and executes it if:
             - The command is not empty
@@ -186,8 +447,19 @@ class ClientHandler():
                 required_arguments) > len(input_arguments):
             return "The number of arguments is incorrect, please try again"
 
+        if self.journal is not None:
+            self.journal.record(self.session, command)
+
+        method = getattr(self, command_object["method"])
+
+        # Profile the command if an admin asked for it
+        if self.profiler is not None:
+            session = self.profiler.active(self.user.username if self.user is not None else None, command_string)
+            if session is not None:
+                return session.call(method, input_arguments)
+
         # Execute the command
-        return command_object["method"](input_arguments)
+        return method(input_arguments)
 
     def register(self, arguments):
         """Register a new user  
@@ -197,9 +469,17 @@ class ClientHandler():
 
         Returns:
             str: The response from the executed command
+
+        >>> ClientHandler(None, admins=frozenset(["root"])).register(["root", "x"])
+        'Error: This username is reserved'
         """
         try:
+            # Admin accounts are only created by the operator in the database
+            if arguments[0] in self.admins:
+                raise Exception("This username is reserved")
+
             self.user = self.DB.register(arguments[0], arguments[1])
+            self.admin = False
             return "Successfully registered"
         except Exception as e:
             return "Error: " + str(e)
@@ -215,9 +495,29 @@ class ClientHandler():
         """
 
         try:
-            self.user = self.DB.login(arguments[0], arguments[1])
-            # intialize the file manager
-            self.FileManager = FileManager(self.user.username)
+            user = self.DB.login(arguments[0], arguments[1])
+            # Users added to the database before usernames were checked can't log in with an unsafe directory name
+            check_username(user.username)
+
+            # Keep the user's directory from being moved by a rebalance while logged in
+            if self.storage is not None:
+                self.storage.acquire(user.username)
+                self.release_storage()
+                self.storage_user = user.username
+
+            # intialize the file manager, replacing the one of the user the session was logged in as
+            file_manager = FileManager(
+                user.username, self.blob_store, self.compression, self.storage)
+            if self.FileManager is not None:
+                self.FileManager.close()
+            self.FileManager = file_manager
+
+            # The watched path belongs to the previous user, its events must not reach the new one
+            if self.user is not None and self.user.username != user.username:
+                self.unwatch([])
+
+            self.user = user
+            self.admin = user.username in self.admins
             return "Successfully logged in"
         except Exception as e:
             return "Error: " + str(e)
@@ -297,6 +597,74 @@ class ClientHandler():
         except Exception as e:
             return "Error: " + str(e)
 
+    def read_range(self, arguments):
+        """Read a byte range of a file
+
+        Args:
+            arguments (list): The arguments for the command (required: 3)
+
+        Returns:
+            str: The response from the executed command
+
+        >>> ClientHandler(None).read_range(["file", "start", "10"])
+        'Error: The offset and length must be numbers'
+        """
+
+        try:
+            offset, length = int(arguments[1]), int(arguments[2])
+        except ValueError:
+            return "Error: The offset and length must be numbers"
+
+        try:
+            self.ensure_user_is_logged_in()
+            return self.FileManager.read_range(arguments[0], offset, length)
+        except Exception as e:
+            return "Error: " + str(e)
+
+    def write_range(self, arguments):
+        """Write bytes at an offset of a file
+
+        Args:
+            arguments (list): The arguments for the command (required: 3)
+
+        Returns:
+            str: The response from the executed command
+        """
+
+        try:
+            offset, data = int(arguments[1]), bytes.fromhex(arguments[2])
+        except ValueError:
+            return "Error: The offset must be a number and the data hex encoded"
+
+        try:
+            self.ensure_user_is_logged_in()
+            return self.FileManager.write_range(arguments[0], offset, data)
+        except Exception as e:
+            return "Error: " + str(e)
+
+    def checksum(self, arguments):
+        """Get the checksums of a file
+
+        Args:
+            arguments (list): The arguments for the command (required: 1)
+
+        Returns:
+            generator: The checksums streamed back to the client
+        """
+
+        try:
+            chunk_size = int(arguments[1]) if len(arguments) > 1 else None
+        except ValueError:
+            return "Error: The chunk size must be a number"
+
+        try:
+            self.ensure_user_is_logged_in()
+            if chunk_size is None:
+                return self.FileManager.checksum(arguments[0])
+            return self.FileManager.checksum(arguments[0], chunk_size)
+        except Exception as e:
+            return "Error: " + str(e)
+
     def create_folder(self, arguments):
         """Create a new folder
 
@@ -313,10 +681,298 @@ class ClientHandler():
         except Exception as e:
             return "Error: " + str(e)
 
+    def tree(self, arguments):
+        """List a folder and all its sub folders
+
+        Args:
+            arguments (list): The arguments for the command (optional: 1)
+
+        Returns:
+            generator: The listing streamed back to the client
+        """
+
+        try:
+            self.ensure_user_is_logged_in()
+            return self.FileManager.tree(arguments[0] if len(arguments) > 0 else ".")
+        except Exception as e:
+            return "Error: " + str(e)
+
+    def copy(self, arguments):
+        """Copy a file or folder
+
+        Args:
+            arguments (list): The arguments for the command (required: 2)
+
+        Returns:
+            generator: The progress streamed back to the client
+        """
+
+        try:
+            self.ensure_user_is_logged_in()
+            return self.FileManager.copy(arguments[0], arguments[1])
+        except Exception as e:
+            return "Error: " + str(e)
+
+    def move(self, arguments):
+        """Move or rename a file or folder
+
+        Args:
+            arguments (list): The arguments for the command (required: 2)
+
+        Returns:
+            str: The response from the executed command
+        """
+
+        try:
+            self.ensure_user_is_logged_in()
+            return self.FileManager.move(arguments[0], arguments[1])
+        except Exception as e:
+            return "Error: " + str(e)
+
+    def remove(self, arguments):
+        """Remove a file or folder
+
+        Args:
+            arguments (list): The arguments for the command (required: 1)
+
+        Returns:
+            generator: The progress streamed back to the client
+        """
+
+        try:
+            self.ensure_user_is_logged_in()
+            return self.FileManager.remove(arguments[0])
+        except Exception as e:
+            return "Error: " + str(e)
+
+    def watch(self, arguments):
+        """Watch a file or folder and push its changes to the client
+           Events are pushed as frames, so responses must be framed by negotiating compression first
+
+        Args:
+            arguments (list): The arguments for the command (optional: 1)
+
+        Returns:
+            str: The response from the executed command
+
+        >>> handler = ClientHandler(None)
+        >>> handler.user = "john"
+        >>> handler.watch([])
+        "Error: Events can only be pushed once responses are framed, send 'compress' first"
+        """
+
+        try:
+            self.ensure_user_is_logged_in()
+
+            if not self.framed:
+                raise Exception("Events can only be pushed once responses are framed, send 'compress' first")
+
+            path = self.FileManager.resolve(arguments[0] if len(arguments) > 0 else ".")
+
+            # A session watches one path at a time
+            self.unwatch([])
+            self.watcher = Watcher(path, self.push_events)
+
+            return "Watching " + (arguments[0] if len(arguments) > 0 else "current directory")
+        except Exception as e:
+            return "Error: " + str(e)
+
+    def unwatch(self, arguments):
+        """Stop watching
+
+        Args:
+            arguments (list): The arguments for the command (required: 0)
+
+        Returns:
+            str: The response from the executed command
+        """
+        if self.watcher is None:
+            return "Not watching anything"
+
+        self.watcher.stop()
+        self.watcher = None
+        return "Stopped watching"
+
+    def limits(self, arguments):
+        """Show the state of the rate limits
+
+        Args:
+            arguments (list): The arguments for the command (required: 0)
+
+        Returns:
+            str: The response from the executed command
+        """
+
+        try:
+            self.ensure_user_is_admin()
+            if self.limiter is None:
+                return "Rate limiting is disabled"
+            return self.limiter.report()
+        except Exception as e:
+            return "Error: " + str(e)
+
+    def profile(self, arguments):
+        """Start or stop profiling commands
+
+        Args:
+            arguments (list): The arguments for the command (required: 1, optional: 3)
+
+        Returns:
+            str: The response from the executed command
+
+        >>> ClientHandler(None).profile(["status"])
+        'Error: You need to login before using this command'
+        """
+
+        try:
+            self.ensure_user_is_admin()
+            if self.profiler is None:
+                return "Profiling is disabled"
+
+            if arguments[0] == "status":
+                return self.profiler.status()
+
+            if arguments[0] == "stop":
+                path = self.profiler.stop()
+                return "Profiling stopped, " + ("results written to " + path if path else "no commands were profiled")
+
+            try:
+                seconds = float(arguments[1]) if len(arguments) > 1 else 60
+            except ValueError:
+                return "Error: The number of seconds must be a number"
+            user = arguments[2] if len(arguments) > 2 and arguments[2] != "*" else None
+            command = arguments[3] if len(arguments) > 3 else None
+
+            return str(self.profiler.start(arguments[0], seconds, user, command))
+        except Exception as e:
+            return "Error: " + str(e)
+
+    def rebalance(self, arguments):
+        """Move users between storage roots after roots were added or retired
+
+        Args:
+            arguments (list): The arguments for the command (required: 0)
+
+        Returns:
+            str: The error if the users can't be moved
+            generator: The progress of the moves otherwise
+        """
+
+        try:
+            self.ensure_user_is_admin()
+            if self.storage is None:
+                return "Storage is not sharded"
+            return self.storage.rebalance()
+        except Exception as e:
+            return "Error: " + str(e)
+
+    def compress(self, arguments):
+        """Enable compression of responses sent to this client
+
+        Args:
+            arguments (list): The arguments for the command (optional: 1)
+
+        Returns:
+            str: The response from the executed command
+
+        >>> handler = ClientHandler(None)
+        >>> handler.compress(["9"])
+        'Compression enabled'
+        >>> handler.response_compression
+        9
+        >>> handler.compress(["fast"])
+        'Error: The compression level must be a number from 1 to 9'
+        """
+
+        try:
+            level = int(arguments[0]) if len(arguments) > 0 else 6
+        except ValueError:
+            level = None
+
+        if level is None or not 1 <= level <= 9:
+            return "Error: The compression level must be a number from 1 to 9"
+
+        # Takes effect after this response has been sent
+        self.response_compression = level
+        return "Compression enabled"
+
+    def search(self, arguments):
+        """Search the files in the current directory and its sub folders by name and content
+
+        Args:
+            arguments (list): The arguments for the command (required: 1)
+
+        Returns:
+            generator: The results streamed back to the client
+        """
+
+        try:
+            self.ensure_user_is_logged_in()
+            text = " ".join(arguments[1:]) or None
+            return self.FileManager.search(arguments[0], text)
+        except Exception as e:
+            return "Error: " + str(e)
+
     """
         Helper methods
     """
 
+    def send(self, response):
+        """Send a response to the client
+           Responses are sent as they are until compression is negotiated, and as frames afterwards
+
+        Args:
+            response (str): The response to send
+        """
+        with self.send_lock:
+            if self.framed:
+                Protocol.send_frame(self.conn, response, self.response_compression)
+            else:
+                self.conn.send(response.encode("UTF-8"))
+                self.framed = self.response_compression is not None
+
+    def push_events(self, events):
+        """Push a batch of changes to the client, called from the watcher's thread
+
+        Args:
+            events (dict): The changed paths and what happened to them
+        """
+        lines = [event + " " + os.path.relpath(path, self.FileManager.user_directory)
+                 for path, event in sorted(events.items())]
+
+        with self.send_lock:
+            Protocol.send_frame(self.conn, "\n".join(lines), self.response_compression, event=True)
+
+    def send_stream(self, responses):
+        """Send a streamed response to the client piece by piece
+           Pushed events are held back until the whole response is sent
+
+        Args:
+            responses (iterable): The pieces of the response
+        """
+        responses = iter(responses)
+
+        with self.send_lock:
+            while True:
+                # Errors while producing the response end it, errors while sending are raised to the caller
+                try:
+                    response = next(responses)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    self.send("Error: " + str(e))
+                    return
+
+                if self.framed:
+                    Protocol.send_frame(
+                        self.conn, response, self.response_compression, more=True)
+                else:
+                    self.conn.send(response.encode("UTF-8"))
+                self.charge(len(response))
+
+            if self.framed:
+                Protocol.send_frame(self.conn, "", self.response_compression)
+
     def help(self, args):
         """Prints the available commands
 
@@ -371,6 +1027,56 @@ class ClientHandler():
         if self.user is None:
             raise Exception("You need to login before using this command")
 
+    def stop(self):
+        """Stop the session once the command in progress is done, called by the server when it shuts down
+           An idle session notices within STOP_INTERVAL, the connection stays intact so the goodbye
+           message can still be sent, also over TLS
+        """
+        self.stopping = True
+
+    def ensure_user_is_admin(self):
+        """Ensure that the logged in user is an admin
+
+        Raises:
+            Exception: If the user is not logged in or not an admin
+
+        >>> ClientHandler(None).ensure_user_is_admin() # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        Exception: You need to login before using this command
+        """
+        self.ensure_user_is_logged_in()
+
+        # Only a login grants admin rights, never a registration
+        if not self.admin:
+            raise Exception("Only admins can use this command")
+
+    def release_storage(self):
+        """Let the directory of the user the session was logged in as be moved again"""
+        if self.storage_user is not None:
+            self.storage.release(self.storage_user)
+            self.storage_user = None
+
+    def rate_limits(self):
+        """Get the rate limits that apply to this connection
+
+        Returns:
+            list: The limits of the connection and of the user if logged in
+        """
+        limits = [self.connection_limits]
+        if self.user is not None:
+            limits.append(self.limiter.user(self.user.username))
+        return limits
+
+    def charge(self, size):
+        """Charge the bytes sent to the client to the rate limits
+
+        Args:
+            size (int): The number of characters sent
+        """
+        if self.limiter is not None:
+            self.limiter.charge(self.rate_limits(), size)
+
     def exit(self, arguments):
         """Exit the program and close the connection
 
@@ -379,6 +1085,8 @@ class ClientHandler():
 
         """        
         debug("Running exit handler")
-        self.conn.send(b"Goodbye!")
-        self.conn.close()
+        # Sent as a frame once responses are framed, and never in the middle of a pushed event
+        self.send("Goodbye!")
+        with self.send_lock:
+            self.conn.close()
         return None
@@ -0,0 +1,334 @@
+"""
+    Transparent compression for stored files
+
+    A compressed file is split into chunks of CHUNK_SIZE bytes that are compressed independently,
+    followed by an index of the position of every chunk. A read at any offset only decompresses the chunks
+    that contain the requested bytes instead of the whole file.
+
+    Layout:
+        header  MAGIC, codec (1 byte), chunk size in bytes (4 bytes)
+        chunks  the compressed chunks one after another
+        index   the start position of every chunk (8 bytes each)
+        footer  the position of the index (8 bytes), the number of chunks (4 bytes), MAGIC
+
+    Appending only decompresses and compresses again the last chunk, then writes the index and footer after
+    the new chunks, so appending to a large compressed log costs about one chunk instead of the whole file.
+
+    Users can write arbitrary bytes, so plain content that starts with MAGIC is always stored compressed
+    (see looks_compressed) and a file on disk that starts with MAGIC was written by the server. The layout
+    is still validated before a file is read as compressed, and no chunk decompresses to more than the chunk size.
+"""
+
+import lzma
+import struct
+import zlib
+
+MAGIC = b"CSZ1"
+CHUNK_SIZE = 64 * 1024
+
+# Largest chunk size accepted when reading a file
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+HEADER = struct.Struct(">4sBI")
+FOOTER = struct.Struct(">QI4s")
+INDEX_ENTRY = struct.Struct(">Q")
+
+# The decompressors are objects so the size of the output can be limited
+CODECS = {
+    "zlib": (0, zlib.compress, zlib.decompressobj),
+    "lzma": (1, lzma.compress, lzma.LZMADecompressor),
+}
+DECOMPRESSORS = {codec_id: decompressor for codec_id, _, decompressor in CODECS.values()}
+COMPRESSORS = {codec_id: compressor for codec_id, compressor, _ in CODECS.values()}
+
+
+def compress(data, codec="zlib", chunk_size=CHUNK_SIZE):
+    """ Compress data into the seekable compressed file format
+
+    Args:
+        data (bytes): The content of the file
+        codec (str): The codec to compress with, 'zlib' or 'lzma' (default: zlib)
+        chunk_size (int): The number of bytes per independently compressed chunk
+
+    Returns:
+        bytes: The compressed file
+
+    Raises:
+        Exception: If the codec is not supported
+
+    >>> data = compress(b"hello world" * 100, chunk_size=64)
+    >>> data.startswith(MAGIC) and data.endswith(MAGIC)
+    True
+    """
+    if codec not in CODECS:
+        raise Exception("Unsupported compression " + codec)
+
+    codec_id, compressor, _ = CODECS[codec]
+
+    output = bytearray(HEADER.pack(MAGIC, codec_id, chunk_size))
+    pack_chunks(output, [], data, compressor, chunk_size, 0)
+
+    return bytes(output)
+
+
+def pack_chunks(output, index, data, compressor, chunk_size, position):
+    """ Compress data into chunks followed by the index of all chunks and the footer
+
+    Args:
+        output (bytearray): Receives the chunks, index and footer
+        index (list): The positions of the chunks before these, the new positions are added to it
+        data (bytes): The content to compress
+        compressor (function): Compresses a chunk
+        chunk_size (int): The number of bytes per chunk
+        position (int): The position in the file output starts at
+    """
+    for start in range(0, len(data), chunk_size):
+        index.append(position + len(output))
+        output += compressor(data[start:start + chunk_size])
+
+    index_position = position + len(output)
+    for chunk_position in index:
+        output += INDEX_ENTRY.pack(chunk_position)
+    output += FOOTER.pack(index_position, len(index), MAGIC)
+
+
+def append(path, data):
+    """ Append to a compressed file on disk in place, only the last chunk is decompressed and compressed again
+        The file is invalid while it is written, callers serialize appends and reads of the same file
+
+    Args:
+        path (str): The path of the file
+        data (bytes): The bytes to append
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "log")
+    >>> open(path, "wb").write(compress(b"0123456789", chunk_size=4))
+    83
+    >>> append(path, b"abcdef")
+    >>> read_all(path), read_range(path, 8, 4)
+    (b'0123456789abcdef', b'89ab')
+    """
+    with open(path, "r+b") as f:
+        compressed = CompressedFile(f)
+
+        # The last chunk may be partial, it is compressed again together with the appended bytes
+        index = compressed.index
+        if index:
+            data = compressed.chunk(len(index) - 1) + data
+            position = index.pop()
+        else:
+            position = compressed.index_position
+
+        output = bytearray()
+        pack_chunks(output, index, data, COMPRESSORS[compressed.codec_id], compressed.chunk_size, position)
+
+        f.seek(position)
+        f.write(output)
+        f.truncate()
+
+
+def looks_compressed(data):
+    """ Check if plain content starts like a compressed file, such content must be stored compressed
+
+    Args:
+        data (bytes): The plain content
+
+    Returns:
+        bool: True if the content starts with MAGIC
+
+    >>> looks_compressed(b"CSZ1" + bytes(20)), looks_compressed(b"hello")
+    (True, False)
+    """
+    return data.startswith(MAGIC)
+
+
+def read_layout(f):
+    """ Read and validate the header and footer of a compressed file
+
+    Args:
+        f (file): The file opened in binary mode
+
+    Returns:
+        tuple: The codec id, chunk size, index position and number of chunks, None if the file is not compressed
+
+    >>> import io
+    >>> read_layout(io.BytesIO(compress(b"hello", chunk_size=16)))
+    (0, 16, 22, 1)
+    >>> read_layout(io.BytesIO(MAGIC + bytes(40))) is None
+    True
+    """
+    f.seek(0)
+    header = f.read(HEADER.size)
+    size = f.seek(0, 2)
+    if len(header) < HEADER.size or size < HEADER.size + FOOTER.size:
+        return None
+
+    magic, codec_id, chunk_size = HEADER.unpack(header)
+    f.seek(-FOOTER.size, 2)
+    index_position, count, footer_magic = FOOTER.unpack(f.read(FOOTER.size))
+
+    if (magic != MAGIC or footer_magic != MAGIC or codec_id not in DECOMPRESSORS
+            or not 0 < chunk_size <= MAX_CHUNK_SIZE or index_position < HEADER.size
+            or index_position + count * INDEX_ENTRY.size + FOOTER.size != size):
+        return None
+
+    return codec_id, chunk_size, index_position, count
+
+
+def is_compressed(path):
+    """ Check if a stored file is in the compressed format
+
+    Args:
+        path (str): The path of the file
+
+    Returns:
+        bool: True if the file is compressed
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return False
+        return read_layout(f) is not None
+
+
+class CompressedFile():
+    """
+        Random access reader for a compressed file, only the header, footer and index are read when opening
+
+        Args:
+            f (file): The compressed file opened in binary mode
+
+        Attributes:
+            codec_id (int): The id of the codec the chunks are compressed with
+            chunk_size (int): The number of bytes per chunk
+            index (list): The start position of every chunk
+            index_position (int): The position of the index, which is also the end of the last chunk
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+        layout = read_layout(f)
+        if layout is None:
+            raise Exception("The file is not a valid compressed file")
+
+        self.codec_id, self.chunk_size, self.index_position, count = layout
+        self.decompressor = DECOMPRESSORS[self.codec_id]
+
+        f.seek(self.index_position)
+        raw_index = f.read(count * INDEX_ENTRY.size)
+        self.index = [position for position, in INDEX_ENTRY.iter_unpack(raw_index)]
+
+        if self.index != sorted(self.index) or any(not HEADER.size <= position <= self.index_position
+                                                   for position in self.index):
+            raise Exception("The file is not a valid compressed file")
+
+    def chunk(self, number):
+        """ Decompress a single chunk
+
+        Args:
+            number (int): The number of the chunk
+
+        Returns:
+            bytes: The decompressed chunk
+        """
+        start = self.index[number]
+        end = self.index[number + 1] if number + 1 < len(self.index) else self.index_position
+
+        self.f.seek(start)
+
+        # A chunk never holds more than chunk_size bytes, a larger output means the file was crafted
+        data = self.decompressor().decompress(self.f.read(end - start), self.chunk_size + 1)
+        if len(data) > self.chunk_size:
+            raise Exception("The file is not a valid compressed file")
+        return data
+
+    def read(self, offset, length):
+        """ Read bytes starting at an offset, decompressing only the chunks that hold them
+
+        Args:
+            offset (int): The byte offset to start at
+            length (int): The number of bytes to read
+
+        Returns:
+            bytes: The bytes read, shorter than length at the end of the file
+
+        >>> import io
+        >>> f = CompressedFile(io.BytesIO(compress(b"abcdefghij" * 10, "lzma", chunk_size=16)))
+        >>> f.read(10, 12)
+        b'abcdefghijab'
+        >>> f.read(95, 100)
+        b'fghij'
+        """
+        response = b""
+        number = offset // self.chunk_size
+        skip = offset % self.chunk_size
+
+        while len(response) < length and number < len(self.index):
+            response += self.chunk(number)[skip:skip + length - len(response)]
+            number += 1
+            skip = 0
+
+        return response
+
+    def size(self):
+        """ Get the number of bytes of the content, only the last chunk is decompressed
+
+        Returns:
+            int: The size of the content
+
+        >>> import io
+        >>> CompressedFile(io.BytesIO(compress(b"abcdefghij" * 10, chunk_size=16))).size()
+        100
+        """
+        if not self.index:
+            return 0
+        return (len(self.index) - 1) * self.chunk_size + len(self.chunk(len(self.index) - 1))
+
+    def read_all(self):
+        """ Decompress the whole file
+
+        Returns:
+            bytes: The content of the file
+        """
+        return b"".join(self.chunk(number) for number in range(len(self.index)))
+
+
+def read_range(path, offset, length):
+    """ Read bytes from a compressed file on disk
+
+    Args:
+        path (str): The path of the file
+        offset (int): The byte offset to start at
+        length (int): The number of bytes to read
+
+    Returns:
+        bytes: The bytes read
+    """
+    with open(path, "rb") as f:
+        return CompressedFile(f).read(offset, length)
+
+
+def content_size(path):
+    """ Get the number of bytes of the content of a compressed file on disk
+
+    Args:
+        path (str): The path of the file
+
+    Returns:
+        int: The size of the content
+    """
+    with open(path, "rb") as f:
+        return CompressedFile(f).size()
+
+
+def read_all(path):
+    """ Read the whole content of a compressed file on disk
+
+    Args:
+        path (str): The path of the file
+
+    Returns:
+        bytes: The content of the file
+    """
+    with open(path, "rb") as f:
+        return CompressedFile(f).read_all()
@@ -0,0 +1,172 @@
+"""
+    In-process event bus for changes to the users' files, used by the 'watch' command
+
+    The file manager publishes an event for every file or folder it creates, modifies, moves or removes.
+    Watchers subscribe to a path and receive the events for that path and everything below it,
+    coalesced over a short window so a burst of writes to the same file is delivered as one event.
+"""
+
+import os
+import time
+import threading
+
+# Seconds events are collected before they are delivered
+COALESCE_WINDOW = 0.2
+
+
+class EventBus():
+    """
+        Delivers published events to the subscribers of the changed path or one of its parents
+
+        Attributes:
+            subscribers (list): The (path, callback) pairs of all subscriptions
+            lock (Lock): Guards the list of subscribers
+    """
+
+    def __init__(self):
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, path, callback):
+        """ Subscribe to the events of a path and everything below it
+
+        Args:
+            path (str): The normalized path to watch
+            callback (function): Called with the changed path and the event
+
+        Returns:
+            tuple: The subscription, used to unsubscribe
+        """
+        subscription = (path, callback)
+        with self.lock:
+            self.subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Cancel a subscription
+
+        Args:
+            subscription (tuple): The subscription returned by subscribe
+        """
+        with self.lock:
+            if subscription in self.subscribers:
+                self.subscribers.remove(subscription)
+
+    def publish(self, path, event):
+        """ Publish a change
+
+        Args:
+            path (str): The normalized path that changed
+            event (str): What happened, 'created', 'modified' or 'removed'
+
+        >>> bus = EventBus()
+        >>> subscription = bus.subscribe(os.path.join("root", "a"), lambda path, event: print(path, event))
+        >>> bus.publish(os.path.join("root", "a", "b"), "created")
+        root/a/b created
+        >>> bus.publish(os.path.join("root", "ab"), "created")
+        >>> bus.unsubscribe(subscription)
+        >>> bus.publish(os.path.join("root", "a"), "removed")
+        """
+        with self.lock:
+            callbacks = [callback for watched, callback in self.subscribers
+                         if path == watched or path.startswith(os.path.join(watched, ""))]
+
+        for callback in callbacks:
+            callback(path, event)
+
+
+# The bus shared by all sessions
+BUS = EventBus()
+
+
+def publish(path, event):
+    """ Publish a change on the shared bus
+
+    Args:
+        path (str): The normalized path that changed
+        event (str): What happened, 'created', 'modified' or 'removed'
+    """
+    BUS.publish(path, event)
+
+
+class Watcher():
+    """
+        Collects the events below a path and delivers them in batches from its own thread
+        Only the last event of each path within the coalescing window is delivered
+
+        Args:
+            path (str): The normalized path to watch
+            deliver (function): Called with a dict of path -> event for every batch
+            window (float): Seconds events are collected before they are delivered (default: COALESCE_WINDOW)
+            bus (EventBus): The bus to subscribe to (default: the shared bus)
+
+        Attributes:
+            pending (dict): The events collected since the last delivery
+            running (bool): Whether the watcher is still delivering events
+            condition (Condition): Wakes the delivery thread when an event arrives or the watcher is stopped
+    """
+
+    def __init__(self, path, deliver, window=COALESCE_WINDOW, bus=BUS):
+        self.path = path
+        self.deliver = deliver
+        self.window = window
+        self.bus = bus
+
+        self.pending = {}
+        self.running = True
+        self.condition = threading.Condition()
+
+        self.subscription = self.bus.subscribe(path, self.notify)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def notify(self, path, event):
+        """ Collect an event, called by the bus from the thread that made the change
+
+        Args:
+            path (str): The path that changed
+            event (str): What happened
+        """
+        with self.condition:
+            self.pending[path] = event
+            self.condition.notify()
+
+    def run(self):
+        """ Deliver the collected events until the watcher is stopped
+
+        >>> batches = []
+        >>> bus = EventBus()
+        >>> watcher = Watcher("root", batches.append, 0.05, bus)
+        >>> for event in ["created", "modified", "modified"]: bus.publish(os.path.join("root", "f"), event)
+        >>> time.sleep(0.2); watcher.stop()
+        >>> batches == [{os.path.join("root", "f"): "modified"}]
+        True
+        """
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+
+            # Let a burst of changes finish before delivering it
+            time.sleep(self.window)
+
+            with self.condition:
+                if not self.running:
+                    return
+                batch, self.pending = self.pending, {}
+
+            try:
+                self.deliver(batch)
+            except Exception:
+                # The session is gone
+                self.stop()
+                return
+
+    def stop(self):
+        """ Stop delivering events and unsubscribe """
+        self.bus.unsubscribe(self.subscription)
+
+        with self.condition:
+            self.running = False
+            self.condition.notify()
@@ -1,18 +1,77 @@
 import os
+import zlib
+import codecs
+import shutil
+import fnmatch
+import tempfile
+import threading
+import weakref
 from datetime import datetime
 
+import EventBus
+import Compression
+import SearchIndex
+
+# Maximum number of resolved paths cached per session
+RESOLVE_CACHE_SIZE = 1024
+
+# Maximum number of bytes returned by a single range read
+MAX_RANGE = 1024 * 1024
+
+# Default number of bytes covered by each checksum
+CHECKSUM_CHUNK_SIZE = 64 * 1024
+
+# real path -> RLock held while the file is rewritten or appended to in place and while a compressed file is read,
+# dropped once no session holds it
+REWRITE_LOCKS = weakref.WeakValueDictionary()
+REWRITE_LOCKS_LOCK = threading.Lock()
+
+
+def rewrite_lock(path):
+    """ Get the lock serializing the rewrites and reads of a path across all sessions
+
+    Args:
+        path (str): The path of the file, any path leading to the same file gets the same lock
+
+    Returns:
+        RLock: The lock of the file
+
+    >>> rewrite_lock("root/usr/john/a") is rewrite_lock("root/usr/john/./a")
+    True
+    """
+    path = os.path.realpath(path)
+    with REWRITE_LOCKS_LOCK:
+        lock = REWRITE_LOCKS.get(path)
+        if lock is None:
+            lock = REWRITE_LOCKS[path] = threading.RLock()
+        return lock
+
 
 class FileManager():
-    def __init__(self, username):
+    # One file manager exists per logged in session, without a __dict__ it takes less memory
+    __slots__ = ("user_directory", "wd", "current_file", "blob_store", "compression", "index", "real_root", "resolved",
+                 "temp_directory")
+
+    def __init__(self, username, blob_store=None, compression=None, storage=None):
         """class FileManager
 
         Args:
             username (str): The username of the current user
+            blob_store (BlobStore): The shared content-addressed store files are written to (default: None - files are written in place)
+            compression (str): The codec new writes are compressed with, 'zlib' or 'lzma' (default: None - files are stored uncompressed)
+            storage (Storage): The storage roots the user's directory is placed on, replaces blob_store with the one of the user's root (default: None - the directory is root/usr/<username>)
 
         Attributes:
             user_directory (str): The directory of the user
             wd (str): The current working directory
             current_file (File): The current file that is open
+            blob_store (BlobStore): The shared content-addressed store, if deduplication is enabled
+            compression (str): The codec new writes are compressed with, if compression is enabled
+            index (SearchIndex): The index of the words in the user's files, shared by all sessions of the user
+            real_root (str): The canonical path of the user directory with all symbolic links resolved
+            resolved (dict): Cache of (working directory, name) -> checked path, see resolve
+            temp_directory (str): Where new content is written before it replaces a file, on the same root as
+                                  the user directory but outside every user's tree
 
         # Test that the user directory is created and the user is in the root directory
 
@@ -23,18 +82,46 @@ class FileManager():
         >>> os.path.exists(fm.user_directory) 
         True
 
+        # Test that a username can't place the user directory outside of the storage area
+
+        >>> FileManager("..") # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        Exception: Invalid username
+
         """
 
-        self.user_directory = os.path.join(
-            "root", "usr", username)
+        if storage is not None:
+            self.user_directory = storage.locate(username)
+            blob_store = storage.blob_store(self.user_directory)
+            bases = storage.roots + storage.retired
+        else:
+            self.user_directory = os.path.join(
+                "root", "usr", username)
+            bases = [os.path.join("root", "usr")]
+
+        # Every path is checked against the user directory, so it must itself be below the storage area
+        real_directory = os.path.realpath(self.user_directory)
+        base = next((base for base in bases
+                     if real_directory.startswith(os.path.join(os.path.realpath(base), ""))), None)
+        if base is None:
+            raise Exception("Invalid username")
+        self.temp_directory = os.path.join(base if storage is not None else "root", ".tmp")
+
         self.wd = "."  # Current working directory
 
         self.current_file = None
+        self.blob_store = blob_store
+        self.compression = compression
+        self.index = SearchIndex.index_for(self.user_directory)
 
         # Initialize user's directory if it does not exist
         if not os.path.exists(self.user_directory):
             os.makedirs(self.user_directory)
 
+        self.real_root = os.path.realpath(self.user_directory)
+        self.resolved = {}
+
     def get_current_wd(self):
         """
             Get the current working directory
@@ -61,24 +148,24 @@ class FileManager():
         'Name                          Size                          ...
 
         """
-        files = os.listdir(self.get_current_wd())
         width = 30
         response = f"{'Name':{width}}{'Size':{width}}{'Created':{width}}"
         response += "\n" + "-" * width * 3 + "\n"
 
-        for f in files:
+        # os.scandir returns the type of each entry with the listing and caches its stat
+        for entry in os.scandir(self.resolve(".")):
+            f = entry.name
             # If file is a directory, add a '/' to the end of the name
-            if os.path.isfile(os.path.join(self.get_current_wd(), f)):
-                # Get the size of the directory from os
-                size = os.path.getsize(os.path.join(self.get_current_wd(), f))
+            if entry.is_file():
+                stat = entry.stat()
 
-                # Get the creation date of the directory
-                created = os.path.getctime(
-                    os.path.join(self.get_current_wd(), f))
+                # Get the size and creation date of the file
+                size = stat.st_size
+                created = stat.st_ctime
 
                 # Add to the list of files
                 response += f"{f:{width}}{str(size) + 'B':{width}}{str(datetime.fromtimestamp(created)):{width}}\n"
-            elif os.path.isdir(os.path.join(self.get_current_wd(), f)):
+            elif entry.is_dir():
                 # Get size of file
                 response += f"{f+'/'    }\n"
 
@@ -119,24 +206,29 @@ class FileManager():
         >>> fm.change_folder("test")
         'root\\\\test'
 
+        # Names with several components are resolved, but can't leave the user's folder
+        >>> fm.change_folder("../test/..") == "root"
+        True
+        >>> fm.change_folder("test/../..") # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        Exception: Access denied
 
         """
-        if name == "..":
-           # can't go outside the user's folder
-            if self.wd == ".":
-                raise Exception("Already in root")
-            else:
-                self.wd = os.path.split(self.wd)[0]
+        # can't go outside the user's folder
+        if name == ".." and self.wd == ".":
+            raise Exception("Already in root")
 
-        else:
-            # Check if the directory exists
-            if os.path.exists(os.path.join(self.get_current_wd(), name)):
-                self.wd = os.path.join(self.wd, name)
-            else:
-                raise Exception("Directory does not exist")
+        path = self.resolve(name)
+
+        # Check if the directory exists and is a directory
+        if not os.path.isdir(path):
+            raise Exception("Directory does not exist")
 
-        # Replace first '.' with root
-        return self.wd.replace(".", "root", 1)
+        self.wd = os.path.relpath(path, self.user_directory)
+
+        # Show the user's folder as root
+        return os.path.normpath(os.path.join("root", self.wd))
 
     def read_file(self, name):
         """
@@ -182,7 +274,7 @@ class FileManager():
             return "File closed"
 
         # Check if the file exists and is a file
-        if not os.path.exists(os.path.join(self.get_current_wd(), name)):
+        if not os.path.isfile(self.resolve(name)):
             raise Exception("File does not exist")
 
         # If no file is open or the request file is not the current file create new file instance
@@ -220,24 +312,388 @@ class FileManager():
 
         """
 
+        path = self.resolve(name)
+        existed = os.path.exists(path)
+
+        # Plain files can be appended to directly, everything else is rewritten as a whole,
+        # a compressed file is checked under the lock so it is not seen as plain while it is appended to
+        with rewrite_lock(path):
+            if self.blob_store is None and self.compression is None and not (
+                    os.path.exists(path) and Compression.is_compressed(path)) and not (
+                    input is not None and Compression.looks_compressed(input.encode("UTF-8"))):
+                self.write_in_place(path, input)
+            else:
+                self.rewrite_file(path, input)
+
+        # Only the appended words need to be indexed
+        if input is None:
+            self.index.remove(os.path.relpath(path, self.user_directory))
+        else:
+            self.index.add(os.path.relpath(path, self.user_directory), input)
+
+        EventBus.publish(path, "modified" if existed else "created")
+
+        # Ensures that the file is reopened when the next read is called
+        if self.current_file is not None and self.current_file.name == name:
+            self.current_file = None
+
+        return "Successfully wrote to file " + name
+
+    def write_in_place(self, path, input):
+        """Append to or overwrite a file directly on disk
+
+        Args:
+            path (str): The path of the file to write to
+            input (str): The content to append, the file is cleared if None
+        """
+
+        self.unshare(path)
+
         fd = None
 
         # If the file does not exist, create it and if input is empty clear the contents of the file
-        if not os.path.exists(os.path.join(self.get_current_wd(), name)) or input is None:
-            fd = open(os.path.join(self.get_current_wd(), name), "w")
+        if not os.path.exists(path) or input is None:
+            fd = open(path, "w")
 
         else:
-            fd = open(os.path.join(self.get_current_wd(), name), "a")
+            fd = open(path, "a")
             fd.write("\n")
 
         fd.write(input if input is not None else "")
         fd.close()
 
-        # Ensures that the file is reopened when the next read is called
-        if self.current_file is not None and self.current_file.name == name:
-            self.current_file = None
+    def unshare(self, path):
+        """Give a file its own copy of its content if it is linked to a shared blob, before it is modified in place
+           Blob links remain when the server is restarted with deduplication disabled
 
-        return "Successfully wrote to file " + name
+        Args:
+            path (str): The path of the file
+
+        >>> from BlobStore import BlobStore
+        >>> store = BlobStore()
+        >>> digest = store.store("root/usr/john/shared", b"hello world")
+        >>> FileManager("john").write_range("shared", 0, b"HACKED")
+        'Successfully wrote 6 bytes to file shared at offset 0'
+        >>> open(store.blob_path(digest), "rb").read()
+        b'hello world'
+        >>> os.remove("root/usr/john/shared")
+        """
+        if os.path.exists(path) and os.stat(path).st_nlink > 1:
+            # Copy and rename over the file, the blob itself is never written to
+            tmp_path = self.temp_file()
+            try:
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    def rewrite_file(self, path, input):
+        """Append to or overwrite a file that is compressed or deduplicated through the blob store
+           A compressed file that is not deduplicated is appended to in place, only its last chunk is compressed again,
+           otherwise the new content is built in memory and stored as a whole
+
+        Args:
+            path (str): The path of the file to write to
+            input (str): The content to append, the file is cleared if None
+
+        >>> from BlobStore import BlobStore
+        >>> fm = FileManager("john", BlobStore(), "zlib")
+        >>> fm.write_file("dedup", "shared")
+        'Successfully wrote to file dedup'
+        >>> fm.write_file("dedup", "more")
+        'Successfully wrote to file dedup'
+        >>> fm.read_content(os.path.join(fm.get_current_wd(), "dedup"))
+        'shared\\nmore'
+        >>> os.remove("root/usr/john/dedup")
+
+        >>> fm = FileManager("john", compression="zlib")
+        >>> fm.write_file("compressed.log", "first")
+        'Successfully wrote to file compressed.log'
+        >>> fm.write_file("compressed.log", "second")
+        'Successfully wrote to file compressed.log'
+        >>> fm.read_content(fm.resolve("compressed.log"))
+        'first\\nsecond'
+        >>> os.remove("root/usr/john/compressed.log")
+        """
+
+        # Another session rewriting the file at the same time would lose this session's append or its own
+        with rewrite_lock(path):
+            # A file linked to a blob is shared and can't be changed in place
+            if (self.blob_store is None and input is not None and os.path.exists(path)
+                    and Compression.is_compressed(path)):
+                Compression.append(path, ("\n" + input).encode("UTF-8"))
+                return
+
+            content = ""
+            if os.path.exists(path) and input is not None:
+                content = self.read_content(path) + "\n"
+
+            content += input if input is not None else ""
+
+            self.store_content(path, content.encode("UTF-8"))
+
+    def store_content(self, path, data):
+        """Store the whole new content of a file, compressed and through the blob store if they are enabled
+
+        Args:
+            path (str): The path of the file to write to
+            data (bytes): The new content of the file
+
+        >>> fm = FileManager("john")
+        >>> fm.write_range("fake", 0, b"CSZ1" + bytes(20))
+        'Successfully wrote 24 bytes to file fake at offset 0'
+        >>> fm.read_range("fake", 0, 8)
+        '43535a3100000000'
+        >>> os.remove("root/usr/john/fake")
+
+        # Test that no file of the user is used as a temporary file
+        >>> fm = FileManager("john", compression="zlib")
+        >>> fm.write_file("report.tmp", "kept")
+        'Successfully wrote to file report.tmp'
+        >>> fm.write_file("report", "written")
+        'Successfully wrote to file report'
+        >>> fm.read_content(fm.resolve("report.tmp"))
+        'kept'
+        >>> os.remove("root/usr/john/report"); os.remove("root/usr/john/report.tmp")
+        """
+        # Plain content that looks compressed is stored compressed, so only the server writes files starting with MAGIC
+        if self.compression is not None or Compression.looks_compressed(data):
+            data = Compression.compress(data, self.compression or "zlib")
+
+        if self.blob_store is not None:
+            self.blob_store.store(path, data)
+        else:
+            # Write to a unique file outside the user's tree and rename it over the file,
+            # so the file is never seen half written and no file of the user is overwritten
+            tmp_path = self.temp_file()
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    def temp_file(self):
+        """Create an empty temporary file on the same filesystem as the user directory
+
+        Returns:
+            str: The path of the file, which the caller renames over a user file or removes
+        """
+        os.makedirs(self.temp_directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.temp_directory)
+        os.close(fd)
+        return tmp_path
+
+    def close(self):
+        """Give back the resources of the file manager once the session ends, the search index is dropped
+        when it was the last session of the user
+        """
+        SearchIndex.release_index(self.index)
+
+    def read_content(self, path, errors="strict"):
+        """Read the whole content of a stored file, decompressing it if needed
+
+        Args:
+            path (str): The path of the file
+            errors (str): How bytes that are not UTF-8 are decoded (default: strict - raise UnicodeDecodeError)
+
+        Returns:
+            str: The content of the file
+        """
+        # A compressed file is invalid while it is appended to in place
+        with rewrite_lock(path):
+            if Compression.is_compressed(path):
+                return Compression.read_all(path).decode("UTF-8", errors)
+
+            with open(path, "r", encoding="UTF-8", errors=errors) as f:
+                return f.read()
+
+    def read_text(self, path):
+        """Read the whole content of a file to search it, the bytes that are not UTF-8 are left out
+
+        Args:
+            path (str): The path of the file
+
+        Returns:
+            str: The text of the file
+        """
+        return self.read_content(path, "ignore")
+
+    def read_bytes(self, path, offset=0, length=-1):
+        """Read a byte range of the content of a stored file, decompressing only the chunks holding it
+
+        Args:
+            path (str): The path of the file
+            offset (int): The byte offset to start at (default: 0)
+            length (int): The number of bytes to read (default: -1 - until the end of the file)
+
+        Returns:
+            bytes: The bytes read
+        """
+        # A compressed file is invalid while it is appended to in place
+        with rewrite_lock(path):
+            if Compression.is_compressed(path):
+                if length < 0:
+                    return Compression.read_all(path)[offset:]
+                return Compression.read_range(path, offset, length)
+
+            with open(path, "rb") as f:
+                f.seek(offset)
+                return f.read(length)
+
+    def read_range(self, name, offset, length):
+        """Read a byte range of a file, independent of the read_file cursor so interrupted downloads can resume
+           and a file can be downloaded over several connections at once
+
+        Args:
+            name (str): The name of the file
+            offset (int): The byte offset to start at
+            length (int): The number of bytes to read, at most MAX_RANGE
+
+        Returns:
+            str: The bytes read encoded as hex, empty at the end of the file
+
+        Raises:
+            Exception: If the file does not exist or the range is invalid
+
+        >>> fm = FileManager("john")
+        >>> fm.write_file("ranged", "abcdef")
+        'Successfully wrote to file ranged'
+        >>> bytes.fromhex(fm.read_range("ranged", 2, 3))
+        b'cde'
+        >>> fm.write_range("ranged", 4, b"XYZ")
+        'Successfully wrote 3 bytes to file ranged at offset 4'
+        >>> bytes.fromhex(fm.read_range("ranged", 0, 100))
+        b'abcdXYZ'
+        >>> "".join(fm.checksum("ranged", 4))
+        '0 4 ed82cd11\\n4 3 7d29f8ed\\nsize 7 crc32 1d2f7a48'
+        >>> os.remove("root/usr/john/ranged")
+        """
+        path = self.resolve(name)
+
+        if not os.path.isfile(path):
+            raise Exception("File does not exist")
+        if offset < 0 or not 0 < length <= MAX_RANGE:
+            raise Exception(f"The offset must be positive and the length between 1 and {MAX_RANGE}")
+
+        return self.read_bytes(path, offset, length).hex()
+
+    def write_range(self, name, offset, data):
+        """Write bytes at an offset of a file, creating the file if it does not exist
+           Writing past the end of the file leaves a gap of zero bytes, so ranges can be uploaded in any order,
+           as long as the gap is at most MAX_RANGE bytes. Plain files are written in place and compressed files
+           are appended to when the offset is at or past their end, any other write rewrites the whole file
+
+        Args:
+            name (str): The name of the file
+            offset (int): The byte offset to write at
+            data (bytes): The bytes to write
+
+        Returns:
+            str: The response of the write
+
+        Raises:
+            Exception: If the offset is negative or more than MAX_RANGE bytes past the end of the file
+
+        >>> fm = FileManager("john", compression="zlib")
+        >>> fm.write_range("upload", 0, b"abc")
+        'Successfully wrote 3 bytes to file upload at offset 0'
+        >>> fm.write_range("upload", 5, b"def")
+        'Successfully wrote 3 bytes to file upload at offset 5'
+        >>> fm.read_range("upload", 0, 100)
+        '6162630000646566'
+        >>> fm.write_range("upload", 10 ** 9, b"00") # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        Exception: The offset can be at most 1048576 bytes past the end of the file
+        >>> os.remove("root/usr/john/upload")
+        """
+        path = self.resolve(name)
+        existed = os.path.exists(path)
+
+        if offset < 0:
+            raise Exception("The offset must be positive")
+
+        # Plain files are written in place, everything else is rewritten as a whole,
+        # as are writes to the first bytes which could make the content look compressed
+        with rewrite_lock(path):
+            compressed = existed and Compression.is_compressed(path)
+            if compressed:
+                size = Compression.content_size(path)
+            else:
+                size = os.path.getsize(path) if existed else 0
+
+            # The gap is filled with zero bytes, in memory for the files that are rewritten
+            if offset > size + MAX_RANGE:
+                raise Exception(f"The offset can be at most {MAX_RANGE} bytes past the end of the file")
+
+            if self.blob_store is None and self.compression is None and offset >= len(Compression.MAGIC) and not compressed:
+                self.unshare(path)
+                with open(path, "r+b" if existed else "wb") as f:
+                    f.seek(offset)
+                    f.write(data)
+            elif self.blob_store is None and compressed and offset >= size:
+                # Resuming an upload only compresses the last chunk again
+                Compression.append(path, bytes(offset - size) + data)
+            else:
+                content = self.read_bytes(path) if os.path.exists(path) else b""
+                content = content[:offset].ljust(offset, b"\0") + data + content[offset + len(data):]
+                self.store_content(path, content)
+
+        self.index.add(os.path.relpath(path, self.user_directory), data.decode("UTF-8", "ignore"))
+        self.close_file_below(path)
+        EventBus.publish(path, "modified" if existed else "created")
+
+        return f"Successfully wrote {len(data)} bytes to file {name} at offset {offset}"
+
+    def checksum(self, name, chunk_size=CHECKSUM_CHUNK_SIZE):
+        """Compute the CRC32 of a file and of each of its chunks, so a client can verify a transfer
+           and find the chunks it still needs to fetch or send
+
+        Args:
+            name (str): The name of the file
+            chunk_size (int): The number of bytes covered by each chunk checksum
+
+        Returns:
+            generator: One line per chunk with its offset, length and CRC32, then the size and CRC32 of the file
+
+        Raises:
+            Exception: If the file does not exist or the chunk size is invalid
+        """
+        path = self.resolve(name)
+
+        if not os.path.isfile(path):
+            raise Exception("File does not exist")
+        if not 0 < chunk_size <= MAX_RANGE:
+            raise Exception(f"The chunk size must be between 1 and {MAX_RANGE}")
+
+        return self.checksum_lines(path, chunk_size)
+
+    def checksum_lines(self, path, chunk_size):
+        """Generate the checksums of a file, chunk lines are streamed as the file is read
+
+        Args:
+            path (str): The path of the file
+            chunk_size (int): The number of bytes covered by each chunk checksum
+
+        Yields:
+            str: One line per chunk, then the line of the whole file
+        """
+        size = 0
+        crc = 0
+
+        while True:
+            chunk = self.read_bytes(path, size, chunk_size)
+            if not chunk:
+                break
+
+            yield f"{size} {len(chunk)} {zlib.crc32(chunk):08x}\n"
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+
+        yield f"size {size} crc32 {crc:08x}"
 
     def create_folder(self, folder_name):
         """ Create a new folder
@@ -268,13 +724,421 @@ class FileManager():
 
 
         """
-        if os.path.exists(os.path.join(self.get_current_wd(), folder_name)):
+        path = self.resolve(folder_name)
+
+        if os.path.exists(path):
             raise Exception("Folder already exists")
 
-        os.makedirs(os.path.join(self.get_current_wd(), folder_name))
+        os.makedirs(path)
+        EventBus.publish(path, "created")
 
         return "Successfully created folder " + folder_name
 
+    def search(self, pattern, text=None):
+        """ Search the files in the current working directory and its sub folders
+
+        Args:
+            pattern (str): The glob pattern the file names must match, e.g. '*.log'
+            text (str): The words the file must contain (default: None - only names are matched)
+
+        Returns:
+            generator: The results, one block of lines per matching file followed by the number of matches
+
+        >>> fm = FileManager("john")
+        >>> fm.write_file("searched.log", "first line")
+        'Successfully wrote to file searched.log'
+        >>> fm.write_file("searched.log", "an error here")
+        'Successfully wrote to file searched.log'
+        >>> "".join(fm.search("*.log", "ERROR"))
+        'searched.log:2: an error here\\n1 matches'
+        >>> "".join(fm.search("*.txt", "error"))
+        '0 matches'
+        >>> open("root/usr/john/binary.log", "wb").write(b"\\xff\\xfe error in binary")
+        18
+        >>> fm.index = SearchIndex.SearchIndex(fm.user_directory)
+        >>> "".join(fm.search("*.log", "error"))
+        'binary.log:1:  error in binary\\nsearched.log:2: an error here\\n2 matches'
+        >>> os.remove("root/usr/john/searched.log")
+        >>> os.remove("root/usr/john/binary.log")
+        """
+        cwd = self.resolve(".")
+
+        if text is None:
+            return self.search_results(cwd, self.walk_files(cwd), pattern, None)
+
+        # Only the files containing every word are read
+        self.index.build(self.read_text)
+        candidates = [os.path.join(self.user_directory, path)
+                      for path in sorted(self.index.lookup(text))]
+        candidates = [path for path in candidates
+                      if path.startswith(os.path.join(cwd, ""))]
+
+        return self.search_results(cwd, candidates, pattern, text)
+
+    def search_results(self, cwd, paths, pattern, text):
+        """ Generate the results of a search one file at a time so they can be streamed to the client
+
+        Args:
+            cwd (str): The directory the results are relative to
+            paths (iterable): The paths of the files to check
+            pattern (str): The glob pattern the file names must match
+            text (str): The words the matching lines must contain, None to only match names
+
+        Yields:
+            str: The matching path, or the matching lines of a file, and finally the number of matches
+        """
+        words = SearchIndex.tokenize(text) if text is not None else None
+        matches = 0
+
+        for path in paths:
+            if not fnmatch.fnmatch(os.path.basename(path), pattern):
+                continue
+
+            name = os.path.relpath(path, cwd)
+
+            if words is None:
+                matches += 1
+                yield name + "\n"
+                continue
+
+            lines = [f"{name}:{number}: {line}"
+                     for number, line in enumerate(self.read_text(path).split("\n"), 1)
+                     if words <= SearchIndex.tokenize(line)]
+            if lines:
+                matches += len(lines)
+                yield "\n".join(lines) + "\n"
+
+        yield f"{matches} matches"
+
+    def walk_files(self, directory):
+        """ Generate the paths of all files below a directory
+
+        Args:
+            directory (str): The directory to walk
+
+        Yields:
+            str: The path of each file
+        """
+        for entry in os.scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                yield from self.walk_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path
+
+
+    def resolve(self, name):
+        """ Resolve a name relative to the current working directory into a checked path
+            The name may contain sub folders and '..' but the path must stay inside the user's directory,
+            also when symbolic links are followed. Resolved paths are cached per working directory,
+            so repeated operations on the same names skip the path walk.
+
+        Args:
+            name (str): The name or relative path of the file or folder
+
+        Returns:
+            str: The normalized path
+
+        Raises:
+            Exception: If the path leaves the user's directory
+
+        >>> fm = FileManager("john")
+        >>> fm.resolve("a/../b") == os.path.join("root", "usr", "john", "b")
+        True
+        >>> fm.resolve("../jane") # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        Exception: Access denied
+        """
+        key = (self.wd, name)
+        path = self.resolved.get(key)
+
+        if path is None:
+            path = os.path.normpath(os.path.join(self.user_directory, self.wd, name))
+
+            real_path = os.path.realpath(path)
+            if real_path != self.real_root and not real_path.startswith(os.path.join(self.real_root, "")):
+                raise Exception("Access denied")
+
+            if len(self.resolved) >= RESOLVE_CACHE_SIZE:
+                self.resolved.clear()
+            self.resolved[key] = path
+
+        return path
+
+    def tree(self, name="."):
+        """ List a folder and all its sub folders
+
+        Args:
+            name (str): The folder to list (default: the current working directory)
+
+        Returns:
+            generator: The lines of the tree, one per file or folder
+
+        Raises:
+            Exception: If the folder does not exist
+
+        >>> fm = FileManager("john")
+        >>> fm.create_folder("tree")
+        'Successfully created folder tree'
+        >>> fm.write_file("tree/leaf", "x")
+        'Successfully wrote to file tree/leaf'
+        >>> print("".join(fm.tree("tree")))
+        tree/
+            leaf 1B
+        <BLANKLINE>
+        >>> "".join(fm.remove("tree"))
+        'Removed tree/\\nRemoved 2 files and folders'
+        """
+        path = self.resolve(name)
+        if not os.path.isdir(path):
+            raise Exception("Directory does not exist")
+
+        return self.tree_lines(path, 0)
+
+    def tree_lines(self, path, depth):
+        """ Generate the lines of a tree listing
+
+        Args:
+            path (str): The folder to list
+            depth (int): The depth of the folder in the listing
+
+        Yields:
+            str: One line per file or folder
+        """
+        yield " " * 4 * depth + os.path.basename(path) + "/\n"
+
+        for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+            if entry.is_dir(follow_symlinks=False):
+                yield from self.tree_lines(entry.path, depth + 1)
+            else:
+                size = entry.stat(follow_symlinks=False).st_size
+                yield " " * 4 * (depth + 1) + f"{entry.name} {size}B\n"
+
+    def copy(self, source, destination):
+        """ Copy a file or a folder with all its contents
+
+        Args:
+            source (str): The file or folder to copy
+            destination (str): The new path, or an existing folder to copy into
+
+        Returns:
+            generator: The progress of the copy, one line per copied file and a summary
+
+        Raises:
+            Exception: If the source does not exist or the destination already exists
+
+        >>> fm = FileManager("john")
+        >>> fm.write_file("original", "content")
+        'Successfully wrote to file original'
+        >>> "".join(fm.copy("original", "duplicate"))
+        'Copied original\\nCopied 1 files'
+        >>> fm.read_content(fm.resolve("duplicate"))
+        'content'
+        >>> "".join(fm.remove("original")), "".join(fm.remove("duplicate"))
+        ('Removed 1 files and folders', 'Removed 1 files and folders')
+        """
+        source_path, destination_path = self.transfer_paths(source, destination)
+        return self.copy_progress(source_path, destination_path)
+
+    def copy_progress(self, source_path, destination_path):
+        """ Copy a file or folder and generate the progress
+
+        Args:
+            source_path (str): The path to copy
+            destination_path (str): The path of the copy
+
+        Yields:
+            str: One line per copied file and a summary
+        """
+        copied = 0
+
+        for source_file, destination_file in self.copy_tree(source_path, destination_path):
+            copied += 1
+            EventBus.publish(destination_file, "created")
+            yield "Copied " + os.path.relpath(source_file, self.resolve(".")) + "\n"
+
+        self.index.copy(os.path.relpath(source_path, self.user_directory),
+                        os.path.relpath(destination_path, self.user_directory))
+
+        yield f"Copied {copied} files"
+
+    def copy_tree(self, source_path, destination_path):
+        """ Copy a file or folder, folders are walked with os.scandir
+
+        Args:
+            source_path (str): The path to copy
+            destination_path (str): The path of the copy
+
+        Yields:
+            tuple: The source and destination of every copied file
+        """
+        if not os.path.isdir(source_path):
+            self.copy_file(source_path, destination_path)
+            yield source_path, destination_path
+            return
+
+        os.makedirs(destination_path)
+        for entry in os.scandir(source_path):
+            yield from self.copy_tree(entry.path, os.path.join(destination_path, entry.name))
+
+    def copy_file(self, source_path, destination_path):
+        """ Copy a single file using the cheapest method available
+            - Files stored in the blob store are linked to the same blob, which only changes metadata
+            - Other files are copied inside the kernel with os.copy_file_range where it is available
+
+        Args:
+            source_path (str): The file to copy
+            destination_path (str): The path of the copy
+        """
+        if self.blob_store is not None and os.stat(source_path).st_nlink > 1:
+            os.link(source_path, destination_path)
+            return
+
+        if not hasattr(os, "copy_file_range"):
+            shutil.copyfile(source_path, destination_path)
+            return
+
+        with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+            remaining = os.fstat(source.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(source.fileno(), destination.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+
+    def move(self, source, destination):
+        """ Move or rename a file or a folder with all its contents
+
+        Args:
+            source (str): The file or folder to move
+            destination (str): The new path, or an existing folder to move into
+
+        Returns:
+            str: The response of the move
+
+        Raises:
+            Exception: If the source does not exist or the destination already exists
+        """
+        source_path, destination_path = self.transfer_paths(source, destination)
+
+        # Both paths are inside the user's directory, so this is a single rename on the same filesystem
+        os.rename(source_path, destination_path)
+
+        source_name = os.path.relpath(source_path, self.user_directory)
+        self.index.copy(source_name, os.path.relpath(destination_path, self.user_directory))
+        self.index.remove(source_name)
+        self.close_file_below(source_path)
+
+        EventBus.publish(source_path, "removed")
+        EventBus.publish(destination_path, "created")
+
+        return "Moved " + source + " to " + destination
+
+    def remove(self, name):
+        """ Remove a file, or a folder with all its contents
+
+        Args:
+            name (str): The file or folder to remove
+
+        Returns:
+            generator: The progress of the removal, one line per removed folder and a summary
+
+        Raises:
+            Exception: If the file or folder does not exist or is the user's directory
+        """
+        path = self.resolve(name)
+
+        if not os.path.lexists(path):
+            raise Exception("File does not exist")
+        if path == os.path.normpath(self.user_directory):
+            raise Exception("Cannot remove the root directory")
+
+        self.index.remove(os.path.relpath(path, self.user_directory))
+        self.close_file_below(path)
+
+        return self.remove_progress(path)
+
+    def remove_progress(self, path):
+        """ Remove a file or folder and generate the progress
+
+        Args:
+            path (str): The path to remove
+
+        Yields:
+            str: One line per removed folder and a summary
+        """
+        removed = 0
+
+        for removed_path, is_folder in self.remove_tree(path):
+            removed += 1
+            EventBus.publish(removed_path, "removed")
+            if is_folder:
+                yield "Removed " + os.path.relpath(removed_path, self.resolve(".")) + "/\n"
+
+        yield f"Removed {removed} files and folders"
+
+    def remove_tree(self, path):
+        """ Remove a file or folder, folders are walked with os.scandir and emptied before they are removed
+
+        Args:
+            path (str): The path to remove
+
+        Yields:
+            tuple: Every removed path and whether it was a folder
+        """
+        if os.path.isdir(path) and not os.path.islink(path):
+            for entry in os.scandir(path):
+                yield from self.remove_tree(entry.path)
+            os.rmdir(path)
+            yield path, True
+        else:
+            os.remove(path)
+            yield path, False
+
+    def transfer_paths(self, source, destination):
+        """ Resolve and check the paths of a copy or move
+
+        Args:
+            source (str): The file or folder to copy or move
+            destination (str): The new path, or an existing folder to copy or move into
+
+        Returns:
+            tuple: The source and destination paths
+
+        Raises:
+            Exception: If the source does not exist, the destination already exists or is inside the source
+        """
+        source_path = self.resolve(source)
+        destination_path = self.resolve(destination)
+
+        if not os.path.exists(source_path):
+            raise Exception("File does not exist")
+        if source_path == os.path.normpath(self.user_directory):
+            raise Exception("Cannot move or copy the root directory")
+
+        if os.path.isdir(destination_path):
+            destination_path = os.path.join(destination_path, os.path.basename(source_path))
+
+        if os.path.exists(destination_path):
+            raise Exception("Destination already exists")
+        if destination_path.startswith(os.path.join(source_path, "")):
+            raise Exception("Cannot move or copy a folder into itself")
+
+        return source_path, destination_path
+
+    def close_file_below(self, path):
+        """ Close the current file if it is the given path or inside it
+
+        Args:
+            path (str): The path of a file or folder that is removed or moved
+        """
+        if self.current_file is None:
+            return
+
+        file_path = os.path.normpath(self.current_file.file_path)
+        if file_path == path or file_path.startswith(os.path.join(path, "")):
+            self.current_file = None
+
 
 class File():
     """
@@ -287,10 +1151,12 @@ class File():
         Attributes:
             name (str): The name of the file
             file_path (str): The absolute path to the file
-            offset (int): The current read offset of the file
-            read_length (int): The length of content to read each time
+            offset (int): The current read offset of the file in bytes
+            read_length (int): The number of characters to read each time
     """
 
+    __slots__ = ("name", "file_path", "offset", "read_length")
+
     def __init__(self, name, cwd):
 
         self.name = name
@@ -323,13 +1189,40 @@ class File():
         >>> f.read()
         'EOF'
 
+        #? Test that compressed files are read by characters too
+        >>> open("root/usr/john/important", "w").write("\u00e9" * 150)
+        150
+        >>> f = File("important", "root/usr/john")
+        >>> len(f.read()), len(f.read()), f.read()
+        (100, 50, 'EOF')
+        >>> open("root/usr/john/important", "wb").write(Compression.compress(("\u00e9" * 150).encode("UTF-8")))
+        48
+        >>> f = File("important", "root/usr/john")
+        >>> len(f.read()), len(f.read()), f.read()
+        (100, 50, 'EOF')
+
         #? Clean up
         >>> os.remove("root/usr/john/important")
 
         """
-        # read the next 100 characters from the current offset
-        with open(self.file_path, "r") as f:
-            f.seek(self.offset)
-            response = f.read(self.read_length)
-            self.offset += self.read_length
-            return response if response != "" else "EOF"
+        # a UTF-8 character takes at most 4 bytes
+        size = 4 * self.read_length
+
+        # compressed files are read through their index so only the chunks holding the characters are decompressed,
+        # and are invalid while they are appended to in place
+        with rewrite_lock(self.file_path):
+            if Compression.is_compressed(self.file_path):
+                data = Compression.read_range(self.file_path, self.offset, size)
+            else:
+                with open(self.file_path, "rb") as f:
+                    f.seek(self.offset)
+                    data = f.read(size)
+
+        # read the next 100 characters from the current offset, a character cut at the end is left for the next read
+        # and invalid bytes are kept as they are so the offset moves by exactly the bytes returned
+        text = codecs.getincrementaldecoder("UTF-8")("surrogateescape").decode(data)[:self.read_length]
+        consumed = text.encode("UTF-8", "surrogateescape")
+        self.offset += len(consumed)
+
+        response = consumed.decode("UTF-8", "replace")
+        return response if response != "" else "EOF"
@@ -0,0 +1,151 @@
+"""
+    Append-only binary journal of the commands run by the sessions, replayed with replay.py
+
+    The journal is a sequence of records, each one a header followed by the command line as UTF-8:
+        timestamp   seconds since the epoch the command was received (8 bytes, double)
+        session     the session that ran it, the id of the server process in the high 32 bits and the
+                    number of the session in that process in the low 32 bits (8 bytes)
+        length      the number of bytes of the command line (4 bytes)
+
+    An empty command line marks the end of a session. Records are collected in memory and appended
+    in batches by a background thread, so a crash loses at most the last FLUSH_INTERVAL of commands and
+    a partially written last record is ignored when reading. The process id keeps the sessions apart
+    while the old and the new server process both append during a restart. The journal holds the passwords sent with
+    register and login, so it is only readable by its owner.
+"""
+
+import os
+import time
+import struct
+import threading
+import itertools
+
+RECORD = struct.Struct(">dQI")
+
+# Seconds records are collected before they are appended
+FLUSH_INTERVAL = 0.1
+
+# Number of buffered bytes that triggers an append before the interval is over
+BATCH_SIZE = 64 * 1024
+
+
+class Journal():
+    """
+        Appends the commands of all sessions to a journal file
+
+        Args:
+            path (str): The journal file, created if it does not exist and appended to otherwise
+            sync (bool): Whether every batch is fsynced, so it survives a crash of the machine (default: False)
+
+        Attributes:
+            fd (int): The file descriptor of the journal
+            pending (list): The records not yet appended
+            size (int): The number of bytes of the pending records
+            process (int): The id of the server process, prefixed to the session numbers
+            sessions (count): Numbers the sessions of this process
+            running (bool): Whether the journal still accepts records
+            condition (Condition): Guards the pending records and wakes the flushing thread
+
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), "journal")
+        >>> journal = Journal(path)
+        >>> session = journal.session()
+        >>> journal.record(session, "login john secret")
+        >>> journal.record(session, "list")
+        >>> journal.close()
+        >>> [(session, command) for _, session, command in read(path)] == [
+        ...     (os.getpid() << 32 | 1, 'login john secret'), (os.getpid() << 32 | 1, 'list')]
+        True
+    """
+
+    def __init__(self, path, sync=False):
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.sync = sync
+
+        self.pending = []
+        self.size = 0
+        self.process = os.getpid()
+        self.sessions = itertools.count(1)
+        self.running = True
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def session(self):
+        """ Get the number of a new session
+
+        Returns:
+            int: The session number, unique across the server processes appending to the journal
+        """
+        return self.process << 32 | next(self.sessions)
+
+    def record(self, session, command):
+        """ Record a command, it is appended with the next batch
+
+        Args:
+            session (int): The number of the session that runs the command
+            command (str): The command line, empty when the session ended
+        """
+        data = command.encode("utf-8")
+        record = RECORD.pack(time.time(), session, len(data)) + data
+
+        with self.condition:
+            if not self.running:
+                return
+            self.pending.append(record)
+            self.size += len(record)
+            if self.size >= BATCH_SIZE:
+                self.condition.notify()
+
+    def run(self):
+        """ Append the pending records every FLUSH_INTERVAL until the journal is closed """
+        while True:
+            with self.condition:
+                if self.running:
+                    self.condition.wait(FLUSH_INTERVAL)
+                running = self.running
+                batch, self.pending, self.size = self.pending, [], 0
+
+            if batch:
+                # A single write per batch, O_APPEND keeps it after everything written before
+                os.write(self.fd, b"".join(batch))
+                if self.sync:
+                    os.fsync(self.fd)
+
+            if not running:
+                return
+
+    def close(self):
+        """ Append the pending records and close the journal """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+        self.thread.join()
+        os.close(self.fd)
+
+
+def read(path):
+    """ Read the records of a journal
+
+    Args:
+        path (str): The journal file
+
+    Yields:
+        tuple: The timestamp, session and command line of every complete record
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    position = 0
+    while position + RECORD.size <= len(data):
+        timestamp, session, length = RECORD.unpack_from(data, position)
+        position += RECORD.size
+
+        # The last record was only partially written
+        if position + length > len(data):
+            return
+
+        yield timestamp, session, data[position:position + length].decode("utf-8")
+        position += length
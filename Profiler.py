@@ -0,0 +1,353 @@
+"""
+    On-demand profiling of the commands run by the sessions, controlled with the admin 'profile' command
+
+    A profiling window covers the commands of one user, of one command type or of all sessions for a number
+    of seconds, while the server keeps serving. Two modes are available:
+        cprofile    every matching command runs under its own cProfile.Profile, the results are merged
+                    and written as a pstats file (python -m pstats, snakeviz)
+        sample      a thread samples the stacks of the threads running a matching command with
+                    sys._current_frames, the counts are written as collapsed stacks (flamegraph.pl, speedscope)
+
+    Sampling only costs the matching commands the time to register their thread, so it is the one to use
+    on a busy server. Streamed responses are profiled while they are produced, not only when they are created.
+"""
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import collections
+
+# Seconds between two samples of the sampling profiler
+SAMPLE_INTERVAL = 0.01
+
+MODES = ("cprofile", "sample")
+
+
+class ProfileSession():
+    """
+        A profiling window and the results collected during it
+
+        Args:
+            mode (str): 'cprofile' or 'sample'
+            seconds (float): How long the window lasts
+            user (str): The user whose commands are profiled, None for all users
+            command (str): The command type that is profiled, None for all commands
+            path (str): The file the results are written to
+
+        Attributes:
+            deadline (float): The monotonic time the window ends at
+            commands (int): The number of commands profiled
+            stats (Stats): The merged cProfile results, None until a command was profiled
+            stacks (Counter): Collapsed stack -> number of samples
+            threads (dict): Thread ident -> number of matching commands it is running
+            stopped (Event): Set once the window ended
+            lock (Lock): Guards the results and threads
+    """
+
+    def __init__(self, mode, seconds, user, command, path):
+        self.mode = mode
+        self.user = user
+        self.command = command
+        self.path = path
+        self.deadline = time.monotonic() + seconds
+
+        self.commands = 0
+        self.stats = None
+        self.stacks = collections.Counter()
+        self.threads = {}
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+        if mode == "sample":
+            threading.Thread(target=self.sample, daemon=True).start()
+
+    def matches(self, user, command):
+        """ Check whether a command is profiled
+
+        Args:
+            user (str): The logged in user, None if not logged in
+            command (str): The command type
+
+        Returns:
+            bool: Whether the command is in the window
+
+        >>> session = ProfileSession("cprofile", 60, "john", None, "profile.pstats")
+        >>> session.matches("john", "list"), session.matches("mary", "list")
+        (True, False)
+        """
+        return (not self.stopped.is_set() and (self.user is None or self.user == user)
+                and (self.command is None or self.command == command))
+
+    def call(self, function, *args):
+        """ Run a command profiled, streamed responses are profiled while they are produced
+
+        Args:
+            function (function): The handler of the command
+            args: The arguments of the handler
+
+        Returns:
+            The response of the handler
+
+        >>> session = ProfileSession("cprofile", 60, None, None, "profile.pstats")
+        >>> session.call(str.upper, "done")
+        'DONE'
+        >>> "".join(session.call(lambda: (str(i) for i in range(3))))
+        '012'
+        >>> session.commands
+        2
+        """
+        with self.lock:
+            self.commands += 1
+
+        token = self.begin()
+        try:
+            response = function(*args)
+        finally:
+            self.pause(token)
+
+        if response is None or isinstance(response, str):
+            self.end(token)
+            return response
+        return self.stream(response, token)
+
+    def stream(self, responses, token):
+        """ Produce the pieces of a streamed response profiled
+
+        Args:
+            responses (iterable): The pieces of the response
+            token: What begin returned when the command was called, the pieces are added to its results
+
+        Yields:
+            str: The pieces
+        """
+        responses = iter(responses)
+        try:
+            while True:
+                token = self.begin(token)
+                try:
+                    response = next(responses)
+                except StopIteration:
+                    return
+                finally:
+                    self.pause(token)
+                yield response
+        finally:
+            self.end(token)
+
+    def begin(self, token=None):
+        """ Start or resume profiling the current thread
+
+        Args:
+            token: What begin returned before to resume profiling (default: None - start)
+
+        Returns:
+            The profile of the thread, or its ident when sampling
+        """
+        if self.mode == "cprofile":
+            profile = token if token is not None else cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Only one profiler can be active at a time on Python 3.12 and later, this part is not profiled
+                return token
+            return profile
+
+        ident = threading.get_ident()
+        with self.lock:
+            self.threads[ident] = self.threads.get(ident, 0) + 1
+        return ident
+
+    def pause(self, token):
+        """ Stop profiling the current thread until begin is called again
+
+        Args:
+            token: What begin returned
+        """
+        if self.mode == "cprofile":
+            if token is not None:
+                token.disable()
+            return
+
+        with self.lock:
+            self.threads[token] -= 1
+            if self.threads[token] == 0:
+                del self.threads[token]
+
+    def end(self, token):
+        """ Collect the results of a command once it is done
+
+        Args:
+            token: What begin returned
+        """
+        if self.mode != "cprofile" or token is None:
+            return
+
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(token)
+            else:
+                self.stats.add(token)
+
+    def sample(self):
+        """ Count the stacks of the threads running a matching command until the window ends """
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+
+            with self.lock:
+                for ident in self.threads:
+                    frame = frames.get(ident)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                        frame = frame.f_back
+                    if stack:
+                        self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self):
+        """ Write the results to the session's path
+
+        Returns:
+            bool: Whether there were results to write
+        """
+        with self.lock:
+            if self.mode == "cprofile":
+                if self.stats is None:
+                    return False
+                self.stats.dump_stats(self.path)
+                return True
+
+            if not self.stacks:
+                return False
+            with open(self.path, "w") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            return True
+
+    def __str__(self):
+        remaining = max(0, self.deadline - time.monotonic())
+        return (f"Profiling {self.command or 'all commands'} of {self.user or 'all users'} with {self.mode}, "
+                f"{self.commands} commands profiled, {remaining:.0f} seconds left, writing to {self.path}")
+
+
+class Profiler():
+    """
+        Starts and stops the profiling windows of the server, one window at a time
+
+        Args:
+            directory (str): The directory the results are written to (default: profiles)
+
+        Attributes:
+            session (ProfileSession): The current window, None if not profiling
+            lock (Lock): Guards the current window
+
+        >>> import tempfile
+        >>> profiler = Profiler(tempfile.mkdtemp())
+        >>> session = profiler.start("sample", 60, None, "list")
+        >>> profiler.active("john", "list") is session, profiler.active("john", "tree")
+        (True, None)
+        >>> session.call(time.sleep, 0.1)
+        >>> os.path.exists(profiler.stop())
+        True
+        >>> profiler.stop() # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        Exception: Not profiling
+    """
+
+    def __init__(self, directory="profiles"):
+        self.directory = directory
+        self.session = None
+        self.lock = threading.Lock()
+
+    def start(self, mode, seconds, user=None, command=None):
+        """ Start a profiling window, which stops on its own after the given time
+
+        Args:
+            mode (str): 'cprofile' or 'sample'
+            seconds (float): How long the window lasts
+            user (str): The user whose commands are profiled (default: None - all users)
+            command (str): The command type that is profiled (default: None - all commands)
+
+        Returns:
+            ProfileSession: The window
+
+        Raises:
+            Exception: If the mode is unknown or a window is already open
+        """
+        if mode not in MODES:
+            raise Exception("The profiling mode must be one of " + ", ".join(MODES))
+        if seconds <= 0:
+            raise Exception("The profiling time must be positive")
+
+        os.makedirs(self.directory, exist_ok=True)
+        extension = "pstats" if mode == "cprofile" else "collapsed"
+        path = os.path.join(self.directory, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+        with self.lock:
+            if self.session is not None:
+                raise Exception("Already profiling, stop it first")
+            session = self.session = ProfileSession(mode, seconds, user, command, path)
+
+        threading.Thread(target=self.expire, args=[session, seconds], daemon=True).start()
+        return session
+
+    def expire(self, session, seconds):
+        """ Stop a window once its time is up, unless it was stopped before
+
+        Args:
+            session (ProfileSession): The window
+            seconds (float): How long the window lasts
+        """
+        if not session.stopped.wait(seconds):
+            try:
+                self.stop(session)
+            except Exception:
+                pass
+
+    def stop(self, session=None):
+        """ Stop the current window and write its results
+
+        Args:
+            session (ProfileSession): Only stop this window (default: None - the current window)
+
+        Returns:
+            str: The path the results were written to, None if no command was profiled
+
+        Raises:
+            Exception: If not profiling
+        """
+        with self.lock:
+            if self.session is None or (session is not None and self.session is not session):
+                raise Exception("Not profiling")
+            session, self.session = self.session, None
+
+        session.stopped.set()
+        return session.path if session.dump() else None
+
+    def active(self, user, command):
+        """ Get the window a command is profiled in
+
+        Args:
+            user (str): The logged in user, None if not logged in
+            command (str): The command type
+
+        Returns:
+            ProfileSession: The window, None if the command is not profiled
+        """
+        session = self.session
+        if session is not None and session.matches(user, command):
+            return session
+        return None
+
+    def status(self):
+        """ Describe the current window
+
+        Returns:
+            str: The window or that nothing is profiled
+        """
+        session = self.session
+        return str(session) if session is not None else "Not profiling"
@@ -0,0 +1,213 @@
+"""
+    Framed wire protocol used once a client has negotiated compression with the 'compress' command
+
+    Every response is sent as a frame: the payload length (4 bytes), flags (1 byte) and the payload.
+    Payloads larger than COMPRESS_THRESHOLD are zlib compressed and marked with the COMPRESSED flag.
+    Streamed responses are sent as several frames, every frame but the last is marked with the MORE flag.
+    Events of watched paths are pushed at any time as frames marked with the EVENT flag, they are not part of a response.
+
+    The client tools connect through connect and send their commands with command.
+"""
+
+import socket
+import struct
+import zlib
+
+FRAME_HEADER = struct.Struct(">IB")
+
+COMPRESSED = 1
+MORE = 2
+EVENT = 4
+
+COMPRESS_THRESHOLD = 256
+
+# The server the client tools connect to
+HOST = "localhost"
+PORT = 8080
+
+# Connect with TLS, verifying the server against CAFILE (None uses the system certificates)
+TLS = False
+CAFILE = None
+
+# Created on the first TLS connection and shared by all of them, so their sessions can be resumed
+TLS_CONTEXT = None
+
+
+def send_frame(conn, message, level=None, more=False, event=False):
+    """ Send a message as a single frame
+
+    Args:
+        conn (socket): The socket to send on
+        message (str): The message to send
+        level (int): The zlib compression level (default: None - the payload is not compressed)
+        more (bool): Whether more frames of the same response follow (default: False)
+        event (bool): Whether the frame is a pushed event rather than part of a response (default: False)
+    """
+    payload = message.encode("UTF-8")
+    flags = MORE if more else 0
+    if event:
+        flags |= EVENT
+
+    if level is not None and len(payload) > COMPRESS_THRESHOLD:
+        payload = zlib.compress(payload, level)
+        flags |= COMPRESSED
+
+    conn.sendall(FRAME_HEADER.pack(len(payload), flags) + payload)
+
+
+def recv_exactly(conn, size):
+    """ Receive exactly the given number of bytes
+
+    Args:
+        conn (socket): The socket to receive from
+        size (int): The number of bytes to receive
+
+    Returns:
+        bytes: The bytes received
+
+    Raises:
+        IOError: If the connection is closed before all bytes are received
+    """
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise IOError("Connection closed")
+        data += chunk
+
+    return bytes(data)
+
+
+def recv_frame(conn):
+    """ Receive a single frame and decompress its payload if needed
+
+    Args:
+        conn (socket): The socket to receive from
+
+    Returns:
+        tuple: The flags of the frame and the message
+
+    >>> import socket
+    >>> a, b = socket.socketpair()
+    >>> send_frame(a, "x" * 1000, 6)
+    >>> flags, message = recv_frame(b)
+    >>> flags & COMPRESSED, message == "x" * 1000
+    (1, True)
+    """
+    length, flags = FRAME_HEADER.unpack(recv_exactly(conn, FRAME_HEADER.size))
+    payload = recv_exactly(conn, length)
+
+    if flags & COMPRESSED:
+        payload = zlib.decompress(payload)
+
+    return flags, payload.decode("UTF-8")
+
+
+def recv_response(conn, on_event=None):
+    """ Receive a whole response, joining the frames of streamed responses
+
+    Args:
+        conn (socket): The socket to receive from
+        on_event (function): Called with the message of every event received before the response ends (default: None - events are dropped)
+
+    Returns:
+        str: The response
+
+    >>> import socket
+    >>> a, b = socket.socketpair()
+    >>> send_frame(a, "first ", more=True)
+    >>> send_frame(a, "modified f", event=True)
+    >>> send_frame(a, "second")
+    >>> recv_response(b, print)
+    modified f
+    'first second'
+    """
+    response = ""
+
+    while True:
+        flags, message = recv_frame(conn)
+        if flags & EVENT:
+            if on_event is not None:
+                on_event(message)
+            continue
+
+        response += message
+        if not flags & MORE:
+            return response
+
+
+def open_connection(session=None):
+    """ Open a connection to the server at HOST:PORT, over TLS if TLS is set
+
+    Args:
+        session (SSLSession): The TLS session of an earlier connection to resume (default: None - full handshake)
+
+    Returns:
+        socket: The connection, the welcome message is not read yet
+    """
+    global TLS_CONTEXT
+
+    conn = socket.create_connection((HOST, PORT))
+
+    if TLS:
+        if TLS_CONTEXT is None:
+            # Imported only when needed, ssl takes longer to import than the rest of the client
+            import ssl
+
+            TLS_CONTEXT = ssl.create_default_context(cafile=CAFILE)
+        conn = TLS_CONTEXT.wrap_socket(conn, server_hostname=HOST, session=session)
+
+    return conn
+
+
+def connect(session=None):
+    """ Open a connection to the server and negotiate framed responses
+
+    Args:
+        session (SSLSession): The TLS session of an earlier connection to resume (default: None - full handshake)
+
+    Returns:
+        socket: The connection, its TLS session can be resumed once this returns
+
+    Raises:
+        Exception: If the server does not support framed responses
+    """
+    conn = open_connection(session)
+    conn.recv(4096)
+
+    conn.send(b"compress")
+    if conn.recv(4096).decode() != "Compression enabled":
+        raise Exception("The server does not support framed responses")
+
+    return conn
+
+
+def command(conn, text):
+    """ Send a command on a connection with framed responses and receive the whole response
+
+    Args:
+        conn (socket): The connection to the server
+        text (str): The command
+
+    Returns:
+        str: The response
+    """
+    conn.send(text.encode("utf-8"))
+    return recv_response(conn)
+
+
+def login(conn, username, password):
+    """ Login on a connection with framed responses
+
+    Args:
+        conn (socket): The connection to the server
+        username (str): The username to login with
+        password (str): The password to login with
+
+    Raises:
+        Exception: If the login fails
+    """
+    response = command(conn, f"login {username} {password}")
+    if response != "Successfully logged in":
+        raise Exception(response)
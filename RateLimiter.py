@@ -0,0 +1,262 @@
+"""
+    Token bucket rate limiting of commands and bytes per user and per connection
+
+    Every user and every connection has a bucket for the number of commands and one for the number of bytes
+    received and sent. A command is delayed until all its buckets have enough tokens, or rejected with
+    the time to retry after if that would take longer than the maximum delay. Bytes of a response are only
+    known once it is produced, so they are charged afterwards and delay the next command instead.
+"""
+
+import time
+import threading
+
+
+class TokenBucket():
+    """
+        Bucket that refills at a constant rate up to its capacity
+
+        Args:
+            rate (float): The number of tokens added per second
+            capacity (float): The maximum number of tokens, i.e. the allowed burst
+
+        Attributes:
+            tokens (float): The number of tokens available, negative when more was charged than available
+            updated (float): The time the tokens were last refilled
+            lock (Lock): Guards the tokens
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """ Add the tokens accumulated since the last refill, the lock must be held """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """ Get the time until the given number of tokens is available
+
+        Args:
+            amount (float): The number of tokens
+
+        Returns:
+            float: The number of seconds to wait, 0 if the tokens are available now
+
+        >>> bucket = TokenBucket(10, 5)
+        >>> bucket.wait_time(5)
+        0
+        >>> bucket.charge(10)
+        >>> round(bucket.wait_time(5), 1)
+        1.0
+        """
+        with self.lock:
+            self.refill()
+            return max(0, (amount - self.tokens) / self.rate)
+
+    def charge(self, amount):
+        """ Take tokens, the bucket goes into debt if there are not enough
+
+        Args:
+            amount (float): The number of tokens
+        """
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+
+    def state(self):
+        """ Get the tokens available
+
+        Returns:
+            str: The tokens available and the capacity
+        """
+        with self.lock:
+            self.refill()
+            return f"{self.tokens:.0f}/{self.capacity:.0f}"
+
+    def full(self):
+        """ Check whether the bucket refilled to its capacity
+
+        Returns:
+            bool: True if the bucket is as full as a new one
+        """
+        with self.lock:
+            self.refill()
+            return self.tokens >= self.capacity
+
+
+class Limits():
+    """
+        The command and byte buckets of a single user or connection
+
+        Args:
+            limiter (RateLimiter): The limiter whose configuration the buckets are created with
+
+        Attributes:
+            commands (TokenBucket): Tokens for the number of commands
+            bytes (TokenBucket): Tokens for the number of bytes received and sent
+    """
+
+    def __init__(self, limiter):
+        self.commands = TokenBucket(limiter.command_rate, limiter.command_burst)
+        self.bytes = TokenBucket(limiter.byte_rate, limiter.byte_burst)
+
+    def __str__(self):
+        return f"commands {self.commands.state():>16}  bytes {self.bytes.state():>24}"
+
+    def full(self):
+        """ Check whether both buckets refilled, so the limits can be replaced by new ones """
+        return self.commands.full() and self.bytes.full()
+
+
+class RateLimiter():
+    """
+        Rate limits shared by all connections of the server
+
+        Args:
+            command_rate (float): Commands per second allowed for each user and each connection (default: 20)
+            command_burst (float): Commands allowed in a burst (default: 40)
+            byte_rate (float): Bytes per second allowed for each user and each connection (default: 10 MB)
+            byte_burst (float): Bytes allowed in a burst (default: 20 MB)
+            max_delay (float): Longest time a command is delayed before it is rejected instead (default: 1 second)
+
+        Attributes:
+            users (dict): Username -> Limits, shared by all connections of the user
+            connections (dict): Client address -> Limits of each open connection
+            lock (Lock): Guards the users and connections
+            swept (float): The time the users were last swept for idle limits
+    """
+
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, command_rate=20, command_burst=40, byte_rate=10e6, byte_burst=20e6, max_delay=1):
+        self.command_rate = command_rate
+        self.command_burst = command_burst
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+        self.max_delay = max_delay
+
+        self.users = {}
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.swept = time.monotonic()
+
+    def connect(self, address):
+        """ Create the limits of a new connection
+
+        Args:
+            address (str): The address of the client
+
+        Returns:
+            Limits: The limits of the connection
+        """
+        limits = Limits(self)
+        with self.lock:
+            self.connections[address] = limits
+        return limits
+
+    def disconnect(self, address):
+        """ Forget the limits of a closed connection
+
+        Args:
+            address (str): The address of the client
+        """
+        with self.lock:
+            self.connections.pop(address, None)
+
+    def user(self, username):
+        """ Get the limits of a user
+
+        Users whose buckets refilled completely are forgotten every SWEEP_INTERVAL seconds, they get
+        identical new limits on their next command, so idle users do not accumulate.
+
+        Args:
+            username (str): The username
+
+        Returns:
+            Limits: The limits shared by all connections of the user
+
+        >>> limiter = RateLimiter(command_rate=1000)
+        >>> limiter.admit([limiter.user("idle")], 10)
+        >>> limiter.charge([limiter.user("busy")], 10**9)
+        >>> limiter.swept -= RateLimiter.SWEEP_INTERVAL
+        >>> time.sleep(0.01)
+        >>> _ = limiter.user("other")
+        >>> sorted(limiter.users)
+        ['busy', 'other']
+        """
+        with self.lock:
+            if time.monotonic() - self.swept >= self.SWEEP_INTERVAL:
+                self.sweep()
+            if username not in self.users:
+                self.users[username] = Limits(self)
+            return self.users[username]
+
+    def sweep(self):
+        """ Forget the limits of users whose buckets refilled, the lock must be held """
+        self.users = {username: limits for username, limits in self.users.items() if not limits.full()}
+        self.swept = time.monotonic()
+
+    def admit(self, limits, size):
+        """ Wait until a command of the given size may run
+
+        Args:
+            limits (list): The Limits of the connection and of the user if logged in
+            size (int): The number of bytes of the command
+
+        Raises:
+            Exception: If the command would have to wait longer than max_delay, with the time to retry after
+
+        >>> limiter = RateLimiter(command_rate=1, command_burst=1, max_delay=0)
+        >>> limits = [limiter.connect("127.0.0.1:1")]
+        >>> limiter.admit(limits, 10)
+        >>> limiter.admit(limits, 10) # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        Exception: Rate limit exceeded, retry in ... seconds
+        """
+        wait = max(max(bucket.commands.wait_time(1), bucket.bytes.wait_time(size)) for bucket in limits)
+
+        if wait > self.max_delay:
+            raise Exception(f"Rate limit exceeded, retry in {wait:.2f} seconds")
+
+        for bucket in limits:
+            bucket.commands.charge(1)
+            bucket.bytes.charge(size)
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def charge(self, limits, size):
+        """ Charge the bytes of a response once they are sent
+
+        Args:
+            limits (list): The Limits of the connection and of the user if logged in
+            size (int): The number of bytes sent
+        """
+        for bucket in limits:
+            bucket.bytes.charge(size)
+
+    def report(self):
+        """ Describe the state of all buckets
+
+        Returns:
+            str: One line per user and per connection with the tokens available
+        """
+        with self.lock:
+            users = sorted(self.users.items())
+            connections = sorted(self.connections.items())
+
+        response = f"Limits: {self.command_rate:g} commands/s (burst {self.command_burst:g}), "
+        response += f"{self.byte_rate:g} bytes/s (burst {self.byte_burst:g}), max delay {self.max_delay:g}s\n"
+
+        for username, limits in users:
+            response += f"user {username:24}{limits}\n"
+        for address, limits in connections:
+            response += f"conn {address:24}{limits}\n"
+
+        return response
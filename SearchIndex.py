@@ -0,0 +1,191 @@
+"""
+    Inverted index of the words in each user's files, used by the 'search' command
+
+    There is one index per user directory shared by all sessions of that user. The index is built
+    by walking the user's tree on the first search and is kept up to date by the file manager afterwards,
+    so later searches only read the files that contain every searched word. The index is dropped once
+    the last session of the user ends, and is built again on the next search after that.
+"""
+
+import os
+import re
+import threading
+
+TOKEN = re.compile(r"\w+")
+
+# user directory -> SearchIndex
+INDEXES = {}
+INDEXES_LOCK = threading.Lock()
+
+
+def tokenize(text):
+    """ Split text into the set of lower case words it contains
+
+    Args:
+        text (str): The text to split
+
+    Returns:
+        set: The words in the text
+
+    >>> sorted(tokenize("Hello, hello world_1!"))
+    ['hello', 'world_1']
+    """
+    return set(token.lower() for token in TOKEN.findall(text))
+
+
+def index_for(user_directory):
+    """ Get the index shared by all sessions of a user, each session gives it back with release_index
+
+    Args:
+        user_directory (str): The directory of the user
+
+    Returns:
+        SearchIndex: The index of the user
+
+    >>> index = index_for("root/usr/nobody")
+    >>> index_for("root/usr/nobody") is index
+    True
+    >>> release_index(index); "root/usr/nobody" in INDEXES
+    True
+    >>> release_index(index); "root/usr/nobody" in INDEXES
+    False
+    """
+    with INDEXES_LOCK:
+        index = INDEXES.get(user_directory)
+        if index is None:
+            index = INDEXES[user_directory] = SearchIndex(user_directory)
+        index.sessions += 1
+        return index
+
+
+def release_index(index):
+    """ Give back the index of a session that ended, it is dropped once no session of the user uses it
+
+    Args:
+        index (SearchIndex): The index index_for returned
+    """
+    with INDEXES_LOCK:
+        index.sessions -= 1
+        # The index may already have been dropped when the user's directory was moved
+        if index.sessions == 0 and INDEXES.get(index.root) is index:
+            del INDEXES[index.root]
+
+
+class SearchIndex():
+    """
+        Inverted index from words to the files of a user containing them
+
+        Args:
+            root (str): The directory of the user
+
+        Attributes:
+            root (str): The directory of the user
+            postings (dict): Word -> set of file paths relative to root containing it
+            tokens (dict): File path relative to root -> set of words in the file
+            built (bool): Whether the user's tree has been indexed yet, updates are ignored until then
+            sessions (int): The number of sessions using the index, guarded by INDEXES_LOCK
+            lock (Lock): Guards the index against concurrent sessions of the same user
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.postings = {}
+        self.tokens = {}
+        self.built = False
+        self.sessions = 0
+        self.lock = threading.Lock()
+
+    def build(self, read_content):
+        """ Index every file in the user's tree if it is not indexed yet
+
+        Args:
+            read_content (function): Reads the whole content of a file given its path
+        """
+        with self.lock:
+            if self.built:
+                return
+
+            for directory, _, files in os.walk(self.root):
+                for name in files:
+                    path = os.path.join(directory, name)
+                    self._add(os.path.relpath(path, self.root), read_content(path))
+
+            self.built = True
+
+    def add(self, path, text):
+        """ Add the words of text appended to a file
+
+        Args:
+            path (str): The path of the file relative to the user directory
+            text (str): The text that was appended
+        """
+        with self.lock:
+            if self.built:
+                self._add(path, text)
+
+    def remove(self, path):
+        """ Forget a file, or every file below a folder
+
+        Args:
+            path (str): The path of the file or folder relative to the user directory
+        """
+        with self.lock:
+            prefix = os.path.join(path, "")
+            for file_path in [p for p in self.tokens if p == path or p.startswith(prefix)]:
+                for token in self.tokens.pop(file_path):
+                    self.postings[token].discard(file_path)
+                    if not self.postings[token]:
+                        del self.postings[token]
+
+    def copy(self, source, destination):
+        """ Index the copy of a file, or of every file below a folder, without reading it again
+
+        Args:
+            source (str): The path of the copied file or folder relative to the user directory
+            destination (str): The path of the copy relative to the user directory
+        """
+        with self.lock:
+            prefix = os.path.join(source, "")
+            for file_path in [p for p in self.tokens if p == source or p.startswith(prefix)]:
+                copy_path = destination + file_path[len(source):]
+                self._add(copy_path, " ".join(self.tokens[file_path]))
+
+    def lookup(self, text):
+        """ Find the files containing every word of text
+
+        Args:
+            text (str): The text to look for
+
+        Returns:
+            set: The paths relative to the user directory of the files containing every word
+
+        >>> index = SearchIndex("root/usr/nobody")
+        >>> index.built = True
+        >>> index.add("a", "error in module")
+        >>> index.add("b", "module loaded")
+        >>> sorted(index.lookup("module")), sorted(index.lookup("Module error"))
+        (['a', 'b'], ['a'])
+        >>> index.remove("a")
+        >>> sorted(index.lookup("error"))
+        []
+        """
+        with self.lock:
+            matches = None
+            for token in tokenize(text):
+                files = self.postings.get(token, set())
+                matches = set(files) if matches is None else matches & files
+
+            return matches or set()
+
+    def _add(self, path, text):
+        """ Add the words of text to a file, the lock must be held
+
+        Args:
+            path (str): The path of the file relative to the user directory
+            text (str): The text to index
+        """
+        file_tokens = self.tokens.setdefault(path, set())
+
+        for token in tokenize(text):
+            file_tokens.add(token)
+            self.postings.setdefault(token, set()).add(path)
@@ -0,0 +1,294 @@
+"""
+    Placement of the users' directories across several storage roots, e.g. one per disk or mount point
+
+    Users are assigned to a root with a consistent hash ring, so adding or removing a root only moves
+    the users that land on its part of the ring. Below each root the user directories are fanned out by
+    the first characters of the sha256 of the username, <root>/users/<aa>/<bb>/<username>, so no single
+    directory holds all the users.
+
+    A user whose root changed keeps being served from where the directory is until 'rebalance' moves it,
+    which only moves users that are not logged in so the server keeps running while users are moved.
+"""
+
+import os
+import errno
+import bisect
+import shutil
+import hashlib
+import threading
+
+import SearchIndex
+from Users import check_username
+from BlobStore import BlobStore, GC_INTERVAL
+
+# Number of points of each root on the ring, more points spread the users more evenly
+VIRTUAL_NODES = 64
+
+
+def ring_hash(key):
+    """ Get the position of a key on the ring
+
+    Args:
+        key (str): The key to hash
+
+    Returns:
+        int: A 64 bit position
+    """
+    return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing():
+    """
+        Consistent hash ring mapping keys to roots, each root is placed at VIRTUAL_NODES points
+        and a key belongs to the root of the first point at or after its own position
+
+        Args:
+            roots (list): The roots to place keys on, identified by their path
+            virtual_nodes (int): The number of points of each root (default: VIRTUAL_NODES)
+
+        Attributes:
+            positions (list): The sorted positions of all points
+            owners (list): The root of each point, in the order of positions
+
+        >>> keys = [f"user{i}" for i in range(1000)]
+        >>> before = HashRing(["a", "b", "c"])
+        >>> after = HashRing(["a", "b", "c", "d"])
+        >>> moved = [key for key in keys if before.root_for(key) != after.root_for(key)]
+        >>> all(after.root_for(key) == "d" for key in moved)
+        True
+        >>> 150 < len(moved) < 350
+        True
+    """
+
+    def __init__(self, roots, virtual_nodes=VIRTUAL_NODES):
+        points = sorted((ring_hash(f"{root}#{i}"), root) for root in roots for i in range(virtual_nodes))
+        self.positions = [position for position, _ in points]
+        self.owners = [root for _, root in points]
+
+    def root_for(self, key):
+        """ Get the root a key belongs to
+
+        Args:
+            key (str): The key, a username
+
+        Returns:
+            str: The root
+        """
+        i = bisect.bisect_left(self.positions, ring_hash(key)) % len(self.positions)
+        return self.owners[i]
+
+
+class Storage():
+    """
+        The storage roots the users' directories are spread over
+
+        Args:
+            roots (list): The directories users are placed in (default: ["root"])
+            retired (list): Directories users are only moved out of by rebalance, to empty a root before removing it (default: none)
+            dedup (bool): Give every root its own BlobStore, hard links can't cross filesystems (default: False)
+
+        Attributes:
+            ring (HashRing): Places the users on the roots
+            blob_stores (dict): Root -> BlobStore, empty if deduplication is disabled
+            active (dict): Username -> number of sessions using the user's directory
+            moving (set): The users being moved, their sessions wait until the move is done
+            condition (Condition): Guards active and moving
+
+        >>> import tempfile
+        >>> base = tempfile.mkdtemp()
+        >>> storage = Storage([os.path.join(base, "a")])
+        >>> storage.acquire("john") == os.path.join(base, "a", "users", "96", "d9", "john")
+        True
+        >>> storage.release("john")
+
+        # Add a root and move the users that belong to it
+
+        >>> for i in range(20): os.makedirs(storage.acquire(f"user{i}")); storage.release(f"user{i}")
+        >>> storage = Storage([os.path.join(base, "a"), os.path.join(base, "b")])
+        >>> storage.locate("user3") == storage.user_path(os.path.join(base, "a"), "user3")
+        True
+        >>> moving = sum(storage.ring.root_for(f"user{i}") != os.path.join(base, "a") for i in range(20))
+        >>> list(storage.rebalance())[-1] == f"Moved {moving} users, 0 skipped"
+        True
+        >>> storage.locate("user3") == storage.user_path(storage.ring.root_for("user3"), "user3")
+        True
+    """
+
+    def __init__(self, roots=None, retired=None, dedup=False):
+        self.roots = roots or ["root"]
+        self.retired = retired or []
+        self.ring = HashRing(self.roots)
+        self.blob_stores = {root: BlobStore(os.path.join(root, "blobs"), GC_INTERVAL) for root in self.roots} if dedup else {}
+
+        self.active = {}
+        self.moving = set()
+        self.condition = threading.Condition()
+
+    def user_path(self, root, username):
+        """ Get the directory of a user below a root, fanned out by the hash of the username
+
+        Args:
+            root (str): The storage root
+            username (str): The username
+
+        Returns:
+            str: The directory of the user
+
+        Raises:
+            Exception: If the username would place the directory elsewhere
+        """
+        check_username(username)
+        digest = hashlib.sha256(username.encode("utf-8")).hexdigest()
+        return os.path.join(root, "users", digest[:2], digest[2:4], username)
+
+    def locate(self, username):
+        """ Find the directory of a user, where the ring places it unless it was not moved there yet
+
+        Args:
+            username (str): The username
+
+        Returns:
+            str: The directory of the user, which may not exist yet for a new user
+        """
+        target = self.user_path(self.ring.root_for(username), username)
+        if os.path.isdir(target):
+            return target
+
+        # Placed by an earlier set of roots, or in the layout from before the storage was sharded
+        for root in self.roots + self.retired:
+            for path in [self.user_path(root, username), os.path.join(root, "usr", username)]:
+                if os.path.isdir(path):
+                    return path
+
+        return target
+
+    def acquire(self, username):
+        """ Get the directory of a user for a session, the user is not moved until the session releases it
+
+        Args:
+            username (str): The username
+
+        Returns:
+            str: The directory of the user
+        """
+        with self.condition:
+            while username in self.moving:
+                self.condition.wait()
+            self.active[username] = self.active.get(username, 0) + 1
+
+        return self.locate(username)
+
+    def release(self, username):
+        """ Let a user be moved again once its last session ended
+
+        Args:
+            username (str): The username
+        """
+        with self.condition:
+            self.active[username] -= 1
+            if self.active[username] == 0:
+                del self.active[username]
+
+    def blob_store(self, user_directory):
+        """ Get the blob store on the same root as a user directory
+
+        Args:
+            user_directory (str): The directory of the user
+
+        Returns:
+            BlobStore: The blob store of the root, None if deduplication is disabled or the root is retired
+        """
+        for root, blob_store in self.blob_stores.items():
+            if user_directory.startswith(os.path.join(root, "")):
+                return blob_store
+        return None
+
+    def users(self):
+        """ Find the directories of all users on all roots
+
+        Yields:
+            tuple: The username and its directory
+        """
+        for root in self.roots + self.retired:
+            users = os.path.join(root, "users")
+            if os.path.isdir(users):
+                for first in os.scandir(users):
+                    for second in os.scandir(first.path):
+                        for entry in os.scandir(second.path):
+                            if entry.is_dir(follow_symlinks=False) and not entry.name.endswith(".tmp-rebalance"):
+                                yield entry.name, entry.path
+
+            # The layout from before the storage was sharded
+            legacy = os.path.join(root, "usr")
+            if os.path.isdir(legacy):
+                for entry in os.scandir(legacy):
+                    if entry.is_dir(follow_symlinks=False):
+                        yield entry.name, entry.path
+
+    def rebalance(self):
+        """ Move every user that is not logged in to the directory the ring places it in
+
+        Yields:
+            str: A line for every user moved or skipped, then a summary
+        """
+        moved = 0
+        skipped = 0
+
+        for username, path in list(self.users()):
+            target = self.user_path(self.ring.root_for(username), username)
+            if path == target:
+                continue
+
+            with self.condition:
+                if username in self.active:
+                    skipped += 1
+                    yield f"Skipped {username}, logged in\n"
+                    continue
+                self.moving.add(username)
+
+            try:
+                # An empty directory is left by a session that logged in before the user was found
+                if os.path.exists(target) and os.listdir(target):
+                    skipped += 1
+                    yield f"Skipped {username}, both {path} and {target} exist\n"
+                    continue
+
+                self.move(path, target)
+                moved += 1
+                yield f"Moved {username} from {path} to {target}\n"
+            finally:
+                with self.condition:
+                    self.moving.discard(username)
+                    self.condition.notify_all()
+
+        yield f"Moved {moved} users, {skipped} skipped"
+
+    def move(self, source, target):
+        """ Move a user directory, renamed when on the same filesystem and copied otherwise
+
+        Args:
+            source (str): The current directory of the user
+            target (str): The new directory of the user
+        """
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        if os.path.isdir(target):
+            os.rmdir(target)
+
+        try:
+            os.rename(source, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+            # Copy next to the target and rename it into place, so the user is never half moved
+            tmp_path = target + ".tmp-rebalance"
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+            shutil.copytree(source, tmp_path, symlinks=True)
+            os.rename(tmp_path, target)
+            shutil.rmtree(source)
+
+        # The index of the old directory is rebuilt for the new one on the next search
+        with SearchIndex.INDEXES_LOCK:
+            SearchIndex.INDEXES.pop(source, None)
@@ -1,25 +1,129 @@
 
+import os
+import threading
+from array import array
+
+
+def check_username(username):
+    """Check that a username can be used as the name of the user's directory and as a database field
+
+    Args:
+        username (str): The username
+
+    Raises:
+        Exception: If the username is empty, '.' or '..', or contains a path separator or a comma
+
+    >>> check_username('john')
+    >>> check_username('..') # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    Exception: Invalid username
+    """
+    separators = {'/', os.sep, ','}
+    if username in ('', '.', '..') or any(c in separators for c in username):
+        raise Exception("Invalid username, it can't be '.' or '..' or contain '/' or ','")
+
+
 class Users:
 
-    def __init__(self, db='./db/users.csv'):
+    def __init__(self, db='./db/users.csv', background=False, compact=False):
         """Class Users
 
+            Args:
+                db (str): The path of the database file
+                background (bool): Load the database in a background thread instead of before returning (default: False)
+                compact (bool): Keep the users in a UserTable instead of a list of User objects (default: False)
+
             Attributes:
-                users (list): A list of all users
+                users (list): A list of all users, or a UserTable if compact
+                lock (RLock): Serializes registering users and saving the database, logins don't take it
+                loaded (Event): Set once the database is loaded, register and login wait for it
+                error (Exception): The error that occurred while loading the database, if any
+                frozen (bool): Whether registrations are refused because another process writes the database now
 
             Methods:
                 register(username, password): Registers a new user
                 login(username, password): Logs in a user
+                freeze(): Stops registering users
         """
         self.db = db
+        self.compact = compact
+        self.lock = threading.RLock()
 
-        # Load all users from the database
         self.users = []
+        self.loaded = threading.Event()
+        self.error = None
+        self.frozen = False
+
+        if background:
+            threading.Thread(target=self.load, daemon=True).start()
+        else:
+            self.load()
+            if self.error is not None:
+                raise self.error
+
+    def load(self):
+        """Load all users from the database
+
+        # Test loading in the background
+
+        >>> users = Users("./db/test-users.csv")
+        >>> users.flush()
+        >>> users.register('test', 'test') # doctest: +ELLIPSIS
+        <Users.User object at ...
+        >>> users = Users("./db/test-users.csv", background=True)
+        >>> users.login('test', 'test') # doctest: +ELLIPSIS
+        <Users.User object at ...
+        >>> users = Users("./db/test-users.csv", compact=True)
+        >>> users.login('test', 'test').username
+        'test'
+
+        """
+        users = []
+
+        try:
+            if self.compact:
+                with open(self.db, 'rb') as f:
+                    users = UserTable(f.read())
+            else:
+                with open(self.db, 'r') as f:
+                    for line in f:
+                        username, password = line.strip('\n').split(',')
+                        users.append(User(username, password))
+        except Exception as e:
+            self.error = e
+
+        self.users = users
+        self.loaded.set()
+
+    def wait_until_loaded(self):
+        """Wait for the database to be loaded
+
+        Raises:
+            Exception: If the database could not be loaded
+        """
+        self.loaded.wait()
+
+        if self.error is not None:
+            raise Exception('The user database could not be loaded: ' + str(self.error))
 
-        with open(self.db, 'r') as f:
-            for line in f.readlines():
-                username, password = line.strip('\n').split(',')
-                self.users.append(User(username, password))
+    def find(self, username):
+        """Find a user by username
+
+        Args:
+            username (str): The username of the user
+
+        Returns:
+            User: The user, or None if the user does not exist
+        """
+        if isinstance(self.users, UserTable):
+            return self.users.find(username)
+
+        for user in self.users:
+            if user.username == username:
+                return user
+
+        return None
 
     def register(self, username, password):
         """Registers a new user and saves it to the database
@@ -46,19 +150,35 @@ class Users:
         ...
         Exception: User already exists
 
+        # Test registering once the database was handed over
+        >>> users = Users("./db/test-users.csv")
+        >>> users.freeze()
+        >>> users.register('other', 'test') # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        Exception: The server is restarting
+
         """
 
-        # Check if the username is already taken
-        for user in self.users:
-            if user.username == username:
+        check_username(username)
+        self.wait_until_loaded()
+
+        # Two sessions registering at once must not both take the username or append to the table together
+        with self.lock:
+            # The new server process would save its own users over this one's
+            if self.frozen:
+                raise Exception('The server is restarting, register again on a new connection')
+
+            # Check if the username is already taken
+            if self.find(username) is not None:
                 raise Exception('Username already taken')
 
-        # Create a new user
-        new_user = User(username, password)
-        self.users.append(new_user)
+            # Create a new user
+            new_user = User(username, password)
+            self.users.append(new_user)
 
-        # Save the new user to the database
-        self.save()
+            # Save the new user to the database
+            self.save()
 
         return new_user
 
@@ -97,18 +217,20 @@ class Users:
 
         """
 
+        self.wait_until_loaded()
+
         # Check that the user exists
-        for user in self.users:
-            # Find the user
-            if user.username == username:
-                # Check that the password is correct
-                if user.password == password:
-                    return user
-                else:
-                    raise Exception('Incorrect password')
+        user = self.find(username)
 
         # If the user doesn't exist, raise an exception
-        raise Exception('User does not exist')
+        if user is None:
+            raise Exception('User does not exist')
+
+        # Check that the password is correct
+        if user.password != password:
+            raise Exception('Incorrect password')
+
+        return user
 
     def save(self):
         """Saves the database to file
@@ -131,10 +253,29 @@ class Users:
 
         """
 
-        # Save all users to the database
-        with open(self.db, 'w') as f:
-            for user in self.users:
-                f.write(user.username + ',' + user.password + '\n')
+        # Save all users to a temporary file and rename it over the database,
+        # so the database is never left half written if the server stops while saving
+        with self.lock:
+            with open(self.db + '.tmp', 'w') as f:
+                if isinstance(self.users, UserTable):
+                    f.write(self.users.data.decode())
+                else:
+                    for user in self.users:
+                        f.write(user.username + ',' + user.password + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(self.db + '.tmp', self.db)
+
+    def freeze(self):
+        """Stop registering users, on restart the new server process loads and saves the database from then on
+
+           Each process only knows the users it loaded or registered, so a user registered by the new process
+           can't log in on the connections still served by this one.
+        """
+        # Let a save in progress finish first
+        with self.lock:
+            self.frozen = True
 
     def flush(self):
         """Flushes the database both locally and on file
@@ -143,14 +284,18 @@ class Users:
             This will delete all users in the database, only use in testing
 
         """
+        # A load still in progress would bring the users back
+        self.loaded.wait()
 
         with open(self.db, 'w') as f:
             f.write('')
 
-        self.users = []
+        self.users = UserTable() if self.compact else []
 
 
 class User:
+    __slots__ = ('username', 'password')
+
     def __init__(self, username, password):
         """Class User
         Just a class to hold a username and password for a user that is logged in or in the database
@@ -167,3 +312,144 @@ class User:
 
     def __str__(self):
         return 'User(' + self.username + ',' + self.password + ')'
+
+
+class UserTable:
+    """Compact table of users for large databases
+
+        The 'username,password' lines of the database are kept in a single bytearray and found through
+        an open addressing hash table of their offsets, instead of a User object and two strings per user.
+        User objects are only created when a user is looked up.
+
+        Args:
+            data (bytes): The content of the database file (default: empty)
+
+        Attributes:
+            data (bytearray): The lines of all users
+            offsets (array): Hash table of the offset of each user's line, -1 for an empty slot, replaced
+                             by a larger filled table when it grows so lookups without the lock see one or the other
+            count (int): The number of users
+
+        >>> table = UserTable(b"john,secret\\nmary,hunter2\\n")
+        >>> table.find('mary').password
+        'hunter2'
+        >>> table.find('bob') is None
+        True
+        >>> table.append(User('bob', 'pass'))
+        >>> [str(user) for user in table]
+        ['User(john,secret)', 'User(mary,hunter2)', 'User(bob,pass)']
+    """
+    __slots__ = ('data', 'offsets', 'count')
+
+    def __init__(self, data=b''):
+        self.data = bytearray(data)
+        if self.data and not self.data.endswith(b'\n'):
+            self.data += b'\n'
+
+        # Size the hash table for all lines up front so it is never grown while loading
+        size = 8
+        while size < 2 * self.data.count(b'\n'):
+            size *= 2
+        self.offsets = array('q', [-1]) * size
+        self.count = 0
+
+        # Same as calling insert for every line, inlined as it runs once per user while loading
+        offsets = self.offsets
+        mask = size - 1
+        offset = 0
+        for line in bytes(data).split(b'\n'):
+            if line:
+                username = line[:line.index(b',')]
+                i = hash(username) & mask
+                while offsets[i] != -1 and self.username_at(offsets[i]) != username:
+                    i = (i + 1) & mask
+                if offsets[i] == -1:
+                    offsets[i] = offset
+                    self.count += 1
+            offset += len(line) + 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for line in self.data.decode().split('\n')[:-1]:
+            if line:
+                yield User(*line.split(','))
+
+    def username_at(self, offset):
+        """Get the username of the line at an offset"""
+        return bytes(self.data[offset:self.data.index(b',', offset)])
+
+    def slot(self, username, offsets):
+        """Get the slot of a username in a hash table, or the empty slot it would go to
+
+        Args:
+            username (bytes): The encoded username
+            offsets (array): The hash table, the current one or a larger one being filled
+
+        Returns:
+            int: The index in offsets
+        """
+        mask = len(offsets) - 1
+        i = hash(username) & mask
+        while True:
+            offset = offsets[i]
+            if offset == -1 or self.username_at(offset) == username:
+                return i
+            i = (i + 1) & mask
+
+    def insert(self, offset, username):
+        """Add the line at an offset to the hash table, a username that is already present keeps its first line
+           The caller serializes inserts, lookups may run at the same time
+
+        Args:
+            offset (int): The offset of the line in data
+            username (bytes): The encoded username of the line
+
+        >>> table = UserTable()
+        >>> for i in range(100): table.append(User(f'user{i}', 'secret'))
+        >>> len(table.offsets), len(table), all(table.find(f'user{i}') for i in range(100))
+        (256, 100, True)
+        """
+        # Keep the table at most half full so probe sequences stay short
+        if 2 * (self.count + 1) > len(self.offsets):
+            offsets = array('q', [-1]) * (2 * len(self.offsets))
+            for existing in self.offsets:
+                if existing != -1:
+                    offsets[self.slot(self.username_at(existing), offsets)] = existing
+            # Publish the new table only once it holds every user
+            self.offsets = offsets
+
+        offsets = self.offsets
+        i = self.slot(username, offsets)
+        if offsets[i] == -1:
+            offsets[i] = offset
+            self.count += 1
+
+    def find(self, username):
+        """Find a user by username
+
+        Args:
+            username (str): The username of the user
+
+        Returns:
+            User: The user, or None if the user does not exist
+        """
+        # The table may be replaced by a larger one while searching, keep using the one the search started in
+        offsets = self.offsets
+        offset = offsets[self.slot(username.encode(), offsets)]
+        if offset == -1:
+            return None
+
+        line = self.data[offset:self.data.index(b'\n', offset)].decode()
+        return User(*line.split(','))
+
+    def append(self, user):
+        """Add a user, the line is written before it is added to the hash table so lookups never see it half written
+
+        Args:
+            user (User): The user to add
+        """
+        offset = len(self.data)
+        self.data += (user.username + ',' + user.password + '\n').encode()
+        self.insert(offset, user.username.encode())
@@ -0,0 +1,95 @@
+"""
+    Benchmark of the memory taken by each session and by each user of the database
+
+    Measures with tracemalloc
+        - the bytes per logged in session: the ClientHandler with its FileManager and open File, and the
+          search index of its user before the first search, which is dropped when the user's last session ends.
+          A built index grows with the words in the user's files and is not included
+        - the bytes per user loaded from the database, as a list of User objects and as a compact UserTable
+
+    Usage:
+        python benchmarks/memory.py [sessions] [users]
+"""
+
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Users import Users
+from FileManager import FileManager, File
+from ClientHandler import ClientHandler
+
+
+def measure(create):
+    """
+        Measure the memory still allocated by what a function creates
+
+        Args:
+            create (function): Creates the objects to measure and returns them
+
+        Returns:
+            int: The number of bytes allocated
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = create()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    del objects
+    return after - before
+
+
+def create_sessions(count, DB):
+    """
+        Create logged in sessions, each with a file open
+
+        Args:
+            count (int): The number of sessions
+            DB (Users): The database shared by the sessions
+
+        Returns:
+            list: The sessions
+    """
+    sessions = []
+    for i in range(count):
+        handler = ClientHandler(None, DB)
+        handler.user = DB.find(f"user{i}")
+        handler.FileManager = FileManager(handler.user.username)
+        handler.FileManager.current_file = File("notes.txt", handler.FileManager.get_current_wd())
+        sessions.append(handler)
+    return sessions
+
+
+def main():
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+
+    # The file managers create the users' directories relative to the working directory
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("db")
+    with open(os.path.join("db", "users.csv"), "w") as f:
+        for i in range(users):
+            f.write(f"user{i},password{i}\n")
+
+    # Sessions look their users up in a compact table, a list is searched linearly
+    DB = Users(compact=True)
+    # Create the user directories up front, and end the sessions so their search indexes are dropped
+    for handler in create_sessions(sessions, DB):
+        handler.FileManager.close()
+
+    per_session = measure(lambda: create_sessions(sessions, DB)) / sessions
+    per_user = measure(lambda: Users()) / users
+    per_user_compact = measure(lambda: Users(compact=True)) / users
+
+    print(f"{'':30}{'bytes':>10}")
+    print(f"{'per session':30}{per_session:10.0f}")
+    print(f"{'per user, User objects':30}{per_user:10.0f}")
+    print(f"{'per user, UserTable':30}{per_user_compact:10.0f}")
+
+
+if __name__ == "__main__":
+    main()
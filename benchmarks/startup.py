@@ -0,0 +1,114 @@
+"""
+    Benchmark of the cold start of the server as the user database grows
+
+    Starts the server in a new process for databases of different sizes and measures
+        - the time until the first connection is accepted and receives the welcome message
+        - the time until a login succeeds, i.e. until the database is loaded
+
+    The first should stay flat as the database grows, only the second depends on its size.
+
+    Usage:
+        python benchmarks/startup.py [sizes...]
+"""
+
+import os
+import sys
+import time
+import socket
+import tempfile
+import subprocess
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HOST = "localhost"
+PORT = 8182
+
+# Seconds to wait for the server before giving up
+TIMEOUT = 60
+
+
+def create_database(directory, size):
+    """
+        Write a user database with the given number of users, the last one being bench/bench
+
+        Args:
+            directory (str): The directory the server runs in
+            size (int): The number of users
+    """
+    os.makedirs(os.path.join(directory, "db"), exist_ok=True)
+
+    with open(os.path.join(directory, "db", "users.csv"), "w") as f:
+        for i in range(size - 1):
+            f.write(f"user{i},password{i}\n")
+        f.write("bench,bench\n")
+
+
+def wait_for_welcome(deadline):
+    """
+        Connect to the server as soon as it listens and wait for the welcome message
+
+        Args:
+            deadline (float): The time to give up at
+
+        Returns:
+            socket: The connection
+    """
+    while time.perf_counter() < deadline:
+        try:
+            s = socket.create_connection((HOST, PORT))
+        except ConnectionRefusedError:
+            time.sleep(0.001)
+            continue
+        s.recv(4096)
+        return s
+
+    raise Exception("The server did not start")
+
+
+def time_startup(size):
+    """
+        Start the server with a database of the given size
+
+        Args:
+            size (int): The number of users in the database
+
+        Returns:
+            tuple: The times in milliseconds until the welcome message and until a successful login
+    """
+    directory = tempfile.mkdtemp()
+    create_database(directory, size)
+
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-c", f"from server import Server; Server({HOST!r}, {PORT})"],
+                              cwd=directory, env={**os.environ, "PYTHONPATH": REPOSITORY},
+                              stdout=subprocess.DEVNULL)
+
+    try:
+        s = wait_for_welcome(start + TIMEOUT)
+        welcome = time.perf_counter() - start
+
+        s.send(b"login bench bench")
+        response = s.recv(4096).decode()
+        login = time.perf_counter() - start
+        s.close()
+
+        if response != "Successfully logged in":
+            raise Exception(response)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return welcome * 1000, login * 1000
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [1, 10_000, 100_000, 1_000_000]
+
+    print(f"{'users':>10}{'first accept ms':>18}{'login ms':>12}")
+    for size in sizes:
+        welcome, login = time_startup(size)
+        print(f"{size:>10}{welcome:18.1f}{login:12.1f}")
+
+
+if __name__ == "__main__":
+    main()
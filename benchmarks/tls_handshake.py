@@ -0,0 +1,177 @@
+"""
+    Benchmark of the cost of TLS compared to plaintext connections
+
+    Starts a plaintext and a TLS server with a freshly generated self-signed certificate and measures
+        - the time to connect and receive the welcome message, with a full handshake and with a resumed session
+        - the throughput of read_range over a single connection
+
+    Usage (requires the openssl command line tool):
+        python benchmarks/tls_handshake.py [connections]
+"""
+
+import os
+import sys
+import ssl
+import time
+import socket
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Protocol
+from server import Server
+
+HOST = "localhost"
+PLAIN_PORT = 8180
+TLS_PORT = 8181
+
+
+def generate_certificate(directory):
+    """
+        Generate a self-signed certificate for localhost
+
+        Args:
+            directory (str): The directory to write cert.pem and key.pem to
+
+        Returns:
+            tuple: The paths of the certificate and the key
+    """
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+                    "-keyout", keyfile, "-out", certfile], check=True, capture_output=True)
+
+    return certfile, keyfile
+
+
+def connect(port, context=None, session=None):
+    """
+        Connect to a server and wait for the welcome message
+
+        Args:
+            port (int): The port of the server
+            context (SSLContext): The TLS context to connect with (default: None - plaintext)
+            session (SSLSession): The TLS session to resume (default: None - full handshake)
+
+        Returns:
+            socket: The connection
+    """
+    s = socket.create_connection((HOST, port))
+    if context is not None:
+        s = context.wrap_socket(s, server_hostname=HOST, session=session)
+    s.recv(4096)
+    return s
+
+
+def time_connections(count, port, context=None, resume=False):
+    """
+        Measure the average time to set up a connection
+
+        Args:
+            count (int): The number of connections to open
+            port (int): The port of the server
+            context (SSLContext): The TLS context to connect with (default: None - plaintext)
+            resume (bool): Whether to resume the session of the first connection (default: False)
+
+        Returns:
+            tuple: The average time in milliseconds and the number of resumed sessions
+    """
+    session = None
+    if resume:
+        first = connect(port, context)
+        session = first.session
+        first.close()
+
+    resumed = 0
+    start = time.perf_counter()
+
+    for _ in range(count):
+        s = connect(port, context, session)
+        if context is not None and s.session_reused:
+            resumed += 1
+        s.close()
+
+    return (time.perf_counter() - start) / count * 1000, resumed
+
+
+def time_throughput(port, context=None, size=1024 * 1024, rounds=20):
+    """
+        Measure the throughput of read_range over a single connection
+
+        Args:
+            port (int): The port of the server
+            context (SSLContext): The TLS context to connect with (default: None - plaintext)
+            size (int): The size of the file read on each round
+            rounds (int): The number of reads
+
+        Returns:
+            float: The throughput in MB/s of file content
+    """
+    s = connect(port, context)
+
+    def command(text):
+        s.send(text.encode("utf-8"))
+        return Protocol.recv_response(s)
+
+    s.send(b"compress 1")
+    s.recv(4096)
+    command("register bench bench")
+    command("login bench bench")
+    command(f"write_range bench.bin 0 {os.urandom(1000).hex()}")
+    command(f"write_range bench.bin {size - 1} 00")
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        command(f"read_range bench.bin 0 {size}")
+    elapsed = time.perf_counter() - start
+
+    s.close()
+    return size * rounds / elapsed / 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    directory = tempfile.mkdtemp()
+    certfile, keyfile = generate_certificate(directory)
+
+    # The servers create their database and files relative to the working directory
+    os.chdir(directory)
+    os.makedirs("db")
+    open(os.path.join("db", "users.csv"), "w").close()
+
+    # Keep the connection log of the servers out of the results
+    results = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+
+    threading.Thread(target=Server, args=[HOST, PLAIN_PORT], daemon=True).start()
+    threading.Thread(target=Server, args=[HOST, TLS_PORT],
+                     kwargs={"certfile": certfile, "keyfile": keyfile}, daemon=True).start()
+    time.sleep(0.5)
+
+    context = ssl.create_default_context(cafile=certfile)
+
+    plain, _ = time_connections(count, PLAIN_PORT)
+    full, _ = time_connections(count, TLS_PORT, context)
+    resumed, reused = time_connections(count, TLS_PORT, context, resume=True)
+
+    plain_throughput = time_throughput(PLAIN_PORT)
+    tls_throughput = time_throughput(TLS_PORT, context)
+
+    sys.stdout = results
+    print(f"{'Connection setup':30}{'ms':>10}")
+    print(f"{'plaintext':30}{plain:10.3f}")
+    print(f"{'TLS full handshake':30}{full:10.3f}")
+    print(f"{'TLS resumed session':30}{resumed:10.3f}   ({reused}/{count} resumed)")
+    print()
+    print(f"{'read_range throughput':30}{'MB/s':>10}")
+    print(f"{'plaintext':30}{plain_throughput:10.1f}")
+    print(f"{'TLS':30}{tls_throughput:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,59 @@
-import socket
+import Protocol
+
+# Ask the server to compress its responses
+COMPRESS = True
+
+
+def receive(s, framed):
+    """
+        Receive a single response from the server
+
+        Args:
+            s (socket): The connection to the server
+            framed (bool): Whether compression was negotiated and responses are framed
+
+        Returns:
+            str: The response
+    """
+    if framed:
+        return Protocol.recv_response(s)
+
+    return s.recv(4096).decode()
+
+
+def print_response(s, framed):
+    """
+        Print a response from the server, printing the frames of streamed responses as they arrive
+        and the events of watched paths received before it
+
+        Args:
+            s (socket): The connection to the server
+            framed (bool): Whether compression was negotiated and responses are framed
+    """
+    if not framed:
+        print(receive(s, framed))
+        return
+
+    while True:
+        flags, message = Protocol.recv_frame(s)
+
+        # Changes to watched paths that arrived since the last command
+        if flags & Protocol.EVENT:
+            print(message)
+            continue
+
+        print(message, end="", flush=True)
+        if not flags & Protocol.MORE:
+            break
+    print()
+
+
 def main():
     """
         Main function for client side
-        - Cretes a socket
-        - Connects to the server
+        - Connects to the server at Protocol.HOST and Protocol.PORT, over TLS if Protocol.TLS is True
         - Listens for initial message from server
+        - Negotiates compressed responses if COMPRESS is True
         
         While the client is connected to the server:
 
@@ -16,16 +65,18 @@ def main():
     Connection can be closed by typing 'exit' in the command prompt.
 
     """
-    # Create a socket object
-    s = socket.socket()
-
-    # connect to the server on localhost 8080
-    s.connect(('localhost', 8080))
+    # connect to the server, on localhost 8080 by default
+    s = Protocol.open_connection()
 
     # Receive data from the server
     message = s.recv(4096)
     print(message.decode())
 
+    framed = False
+    if COMPRESS:
+        s.send(b"compress")
+        framed = receive(s, False) == "Compression enabled"
+
     # Create main loop
     while True:
         # Get user input
@@ -39,8 +90,7 @@ def main():
         s.send(command.encode("utf-8"))
 
         # Receive the response from the server
-        message = s.recv(4096)
-        print(message.decode())
+        print_response(s, framed)
 
     # close the connection
     s.close()
@@ -0,0 +1,151 @@
+"""
+    Resumable download of a file over several parallel connections
+
+    The CRC32 of every chunk is fetched with the 'checksum' command and compared with the chunks
+    already present in the destination, so only missing or corrupted chunks are downloaded with 'read_range'.
+    Running the same download again after an interruption resumes it.
+
+    Usage:
+        python download.py <username> <password> <file_name> <destination> [connections]
+"""
+
+import os
+import sys
+import zlib
+import queue
+import threading
+
+import Protocol
+
+# Number of bytes fetched by each read_range request
+CHUNK_SIZE = 256 * 1024
+
+# Shared by all connections so only the first one does a full TLS handshake and the others resume its session
+TLS_SESSION = None
+
+
+def connect(username, password):
+    """
+        Connect to the server and login, resuming the TLS session of the first connection
+
+        Args:
+            username (str): The username to login with
+            password (str): The password to login with
+
+        Returns:
+            socket: The connection to the server
+
+        Raises:
+            Exception: If the login fails
+    """
+    global TLS_SESSION
+
+    s = Protocol.connect(TLS_SESSION)
+
+    # TLS 1.3 session tickets arrive after the handshake, so the session is kept once the first message was read
+    if Protocol.TLS:
+        TLS_SESSION = s.session
+
+    Protocol.login(s, username, password)
+    return s
+
+
+def download(username, password, file_name, destination, connections=4):
+    """
+        Download a file, skipping the chunks the destination already holds
+
+        Args:
+            username (str): The username to login with
+            password (str): The password to login with
+            file_name (str): The file to download, relative to the user's root
+            destination (str): The local path to download to
+            connections (int): The number of parallel connections (default: 4)
+
+        Returns:
+            int: The number of bytes downloaded
+
+        Raises:
+            Exception: If the file can't be read or the downloaded file does not match the checksum
+    """
+    s = connect(username, password)
+    response = Protocol.command(s, f"checksum {file_name} {CHUNK_SIZE}")
+    s.close()
+
+    if response.startswith("Error"):
+        raise Exception(response)
+
+    lines = response.split("\n")
+    _, size, _, crc = lines[-1].split(" ")
+    chunks = [line.split(" ") for line in lines[:-1]]
+
+    # Find the chunks that are missing or differ locally
+    mode = "r+b" if os.path.exists(destination) else "w+b"
+    with open(destination, mode) as f:
+        f.truncate(int(size))
+
+        missing = queue.Queue()
+        for offset, length, chunk_crc in chunks:
+            f.seek(int(offset))
+            if f"{zlib.crc32(f.read(int(length))):08x}" != chunk_crc:
+                missing.put((int(offset), int(length), chunk_crc))
+
+    downloaded = [0]
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            conn = connect(username, password)
+            fd = os.open(destination, os.O_WRONLY)
+        except Exception as e:
+            errors.append(e)
+            return
+
+        try:
+            while True:
+                try:
+                    offset, length, chunk_crc = missing.get_nowait()
+                except queue.Empty:
+                    break
+
+                data = bytes.fromhex(Protocol.command(conn, f"read_range {file_name} {offset} {length}"))
+                if f"{zlib.crc32(data):08x}" != chunk_crc:
+                    raise Exception(f"Checksum mismatch at offset {offset}, the file changed during the download")
+
+                os.pwrite(fd, data, offset)
+                with lock:
+                    downloaded[0] += len(data)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            os.close(fd)
+            conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    # Verify the whole file
+    file_crc = 0
+    with open(destination, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            file_crc = zlib.crc32(chunk, file_crc)
+
+    if f"{file_crc:08x}" != crc:
+        raise Exception("The downloaded file does not match the checksum")
+
+    return downloaded[0]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        print("Usage: python download.py <username> <password> <file_name> <destination> [connections]")
+        sys.exit(1)
+
+    count = download(*sys.argv[1:5], int(sys.argv[5]) if len(sys.argv) > 5 else 4)
+    print(f"Downloaded {count} bytes")
@@ -0,0 +1,50 @@
+"""
+    Move users between storage roots on a running server
+
+    After storage roots were added to or retired from the server's configuration, users keep being served
+    from where their directories are. This logs in as an admin and runs the 'rebalance' command, which moves
+    every user that is not logged in to the root the hash ring places it on and streams back the progress.
+    Users that were logged in are skipped, running the tool again later moves them.
+
+    Usage:
+        python rebalance.py <username> <password>
+"""
+
+import sys
+
+import Protocol
+
+
+def rebalance(username, password):
+    """
+        Run the rebalance command and print its progress as it arrives
+
+        Args:
+            username (str): The username of an admin
+            password (str): The password of the admin
+
+        Raises:
+            Exception: If the login fails
+    """
+    s = Protocol.connect()
+
+    try:
+        Protocol.login(s, username, password)
+
+        s.send(b"rebalance")
+        while True:
+            flags, message = Protocol.recv_frame(s)
+            print(message, end="", flush=True)
+            if not flags & Protocol.MORE:
+                break
+        print()
+    finally:
+        s.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: python rebalance.py <username> <password>")
+        sys.exit(1)
+
+    rebalance(sys.argv[1], sys.argv[2])
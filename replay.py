@@ -0,0 +1,238 @@
+"""
+    Replay a command journal recorded by the server against a server
+
+    Every recorded session is replayed over its own connection. With a speed the sessions run at once,
+    with the commands sent at their original pace scaled by the speed, which reproduces the recorded load
+    against a test server. With speed 0 the commands of all sessions are sent one at a time in the order
+    they were recorded, each after the previous one was answered, so a session never runs ahead of a
+    'register' or a write of another session it depends on. Replaying a journal up to a point in time
+    that way against an empty server rebuilds the users and their files as they were then.
+
+    Each connection negotiates framed responses first so the end of every response is known,
+    a recorded 'compress' command is answered the same way either way.
+
+    Usage:
+        python replay.py <journal> [speed] [until]
+
+        speed   1 replays at the original pace, 10 ten times faster, 0 in order without waiting (default: 1)
+        until   only replay the commands received before this time, as seconds since the epoch
+                or an ISO date like 2024-05-01T12:00:00 (default: the whole journal)
+"""
+
+import sys
+import time
+import threading
+from datetime import datetime
+
+import Journal
+import Protocol
+
+
+def load(path, until=None):
+    """
+        Group the records of a journal by session
+
+        Args:
+            path (str): The journal file
+            until (float): Only keep the commands received before this time (default: None - all commands)
+
+        Returns:
+            list: The sessions, each a list of (timestamp, command) in the order they were received
+    """
+    sessions = []
+    current = {}
+    for timestamp, session, command in Journal.read(path):
+        if until is not None and timestamp >= until:
+            break
+
+        commands = current.get(session)
+        if commands is None:
+            commands = current[session] = []
+            sessions.append(commands)
+        commands.append((timestamp, command))
+
+        # A later server process may get the same process id, its sessions are new ones
+        if not command:
+            del current[session]
+    return sessions
+
+
+def replay_session(commands, origin, start, speed, latencies, errors):
+    """
+        Replay the commands of one session over a new connection
+
+        Args:
+            commands (list): The (timestamp, command) pairs of the session
+            origin (float): The timestamp of the first command of the journal
+            start (float): The monotonic time the replay started at
+            speed (float): How much faster than recorded the commands are sent, more than 0
+            latencies (list): Collects the seconds each command took
+            errors (list): Collects the commands that failed with their response
+    """
+    try:
+        conn = Protocol.connect()
+    except Exception as e:
+        errors.append(("connect", str(e)))
+        return
+
+    try:
+        for timestamp, command in commands:
+            delay = start + (timestamp - origin) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            if not run_command(conn, command, latencies, errors):
+                break
+    except Exception as e:
+        errors.append(("connection", str(e)))
+    finally:
+        conn.close()
+
+
+def run_command(conn, command, latencies, errors):
+    """
+        Send a recorded command and wait for its response
+
+        Args:
+            conn (socket): The connection of the session
+            command (str): The command, empty when the session ended
+            latencies (list): Collects the seconds each command took
+            errors (list): Collects the commands that failed with their response
+
+        Returns:
+            bool: Whether the session continues
+    """
+    # The session ended
+    if not command:
+        return False
+
+    sent = time.perf_counter()
+    conn.send(command.encode("utf-8"))
+
+    # The server closes the connection after exit
+    if command.split(" ")[0] == "exit":
+        return False
+
+    response = Protocol.recv_response(conn, on_event=lambda events: None)
+    latencies.append(time.perf_counter() - sent)
+
+    if response.startswith("Error") or response.startswith("Server error"):
+        errors.append((command, response))
+    return True
+
+
+def replay_in_order(path, until, latencies, errors):
+    """
+        Replay the commands of all sessions one at a time in the order they were recorded
+
+        Args:
+            path (str): The journal file
+            until (float): Only replay the commands received before this time, None for all commands
+            latencies (list): Collects the seconds each command took
+            errors (list): Collects the commands that failed with their response
+    """
+    # Session -> connection of the sessions that did not end yet
+    connections = {}
+
+    try:
+        for timestamp, session, command in Journal.read(path):
+            if until is not None and timestamp >= until:
+                break
+
+            conn = connections.get(session)
+            if conn is None:
+                try:
+                    conn = connections[session] = Protocol.connect()
+                except Exception as e:
+                    errors.append(("connect", str(e)))
+                    continue
+
+            try:
+                running = run_command(conn, command, latencies, errors)
+            except Exception as e:
+                errors.append(("connection", str(e)))
+                running = False
+
+            # A later server process may get the same process id, its sessions get new connections
+            if not running:
+                conn.close()
+                del connections[session]
+    finally:
+        for conn in connections.values():
+            conn.close()
+
+
+def replay(path, speed=1, until=None):
+    """
+        Replay a journal, all sessions at once, or one command at a time in the recorded order with speed 0
+
+        Args:
+            path (str): The journal file
+            speed (float): How much faster than recorded the commands are sent, 0 for in order without waiting (default: 1)
+            until (float): Only replay the commands received before this time (default: None - all commands)
+
+        Returns:
+            tuple: The seconds the replay took, the latency of every command and the failed commands
+    """
+    latencies = []
+    errors = []
+
+    if speed == 0:
+        start = time.monotonic()
+        replay_in_order(path, until, latencies, errors)
+        return time.monotonic() - start, latencies, errors
+
+    sessions = load(path, until)
+    if not sessions:
+        return 0, [], []
+
+    origin = min(commands[0][0] for commands in sessions)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=replay_session, args=[commands, origin, start, speed, latencies, errors])
+               for commands in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.monotonic() - start, latencies, errors
+
+
+def parse_time(text):
+    """
+        Parse a point in time given as seconds since the epoch or as an ISO date
+
+        Args:
+            text (str): The time
+
+        Returns:
+            float: The seconds since the epoch
+    """
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python replay.py <journal> [speed] [until]")
+        sys.exit(1)
+
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+    until = parse_time(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    elapsed, latencies, errors = replay(sys.argv[1], speed, until)
+
+    latencies.sort()
+    print(f"Replayed {len(latencies)} commands in {elapsed:.2f} seconds"
+          f" ({len(latencies) / elapsed if elapsed else 0:.0f} commands/s)")
+    if latencies:
+        for percentile in [50, 95, 99]:
+            latency = latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)]
+            print(f"p{percentile:<3}{latency * 1000:10.3f} ms")
+
+    print(f"{len(errors)} errors")
+    for command, response in errors[:10]:
+        print(f"  {command}: {response}")
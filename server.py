@@ -1,7 +1,30 @@
+import os
+import sys
+import time
+import signal
 import socket
 import threading
 from Users import Users
+from BlobStore import BlobStore, GC_INTERVAL
 from ClientHandler import ClientHandler
+from Journal import Journal
+from Storage import Storage
+from Profiler import Profiler
+
+# Seconds a client has to complete the TLS handshake
+HANDSHAKE_TIMEOUT = 10
+
+# Seconds between checks of the accept loop whether the server is stopping
+ACCEPT_INTERVAL = 0.5
+
+# Seconds sessions get to finish their command in progress when the server shuts down
+DRAIN_TIMEOUT = 10
+
+# Seconds sessions may continue in the old process after the listening socket was handed to a new one
+RESTART_TIMEOUT = 300
+
+# Environment variable holding the listening socket inherited from the previous process on restart
+LISTEN_FD = "LISTEN_FD"
 
 
 class Server(socket.socket):
@@ -13,63 +36,268 @@ class Server(socket.socket):
         host (str): The hostname of the server
         port (int): The port number of the server
         DB (Users): The database of users
+        blob_store (BlobStore): The content-addressed store shared by all users, None if deduplication is disabled
+        compression (str): The codec stored files are compressed with, None if compression is disabled
+        tls_context (SSLContext): The TLS context connections are wrapped with, None if TLS is disabled
+        limiter (RateLimiter): The rate limits per user and per connection, None if rate limiting is disabled
+        journal (Journal): Records the commands of all sessions, None if commands are not recorded
+        storage (Storage): The storage roots the users' directories are spread over, None if all users are below root/usr
+        profiler (Profiler): Profiles the commands an admin asks for with the 'profile' command
+        admins (frozenset): The usernames allowed to run admin commands
+        running (bool): Whether the server accepts new connections
+        restarting (bool): Whether the listening socket was handed to a new process
+        sessions (dict): The thread -> ClientHandler of every connected client
+        sessions_lock (Lock): Guards the sessions
 
     Args:
         socket ([type]): [description]
 
     """     
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, dedup=False, compression=None, certfile=None, keyfile=None, limiter=None, compact_users=False, journal=None,
+                 storage_roots=None, retired_roots=None, admins=None):
         """
             Initialize the server and bind it to the host and port
 
         Args:
             host (str): The hostname of the server
             port (int): The port number of the server
+            dedup (bool): Store identical files only once in a shared blob store (default: False)
+            compression (str): Compress stored files with 'zlib' or 'lzma' (default: None - files are stored uncompressed)
+            certfile (str): The PEM certificate chain to serve TLS with (default: None - connections are plaintext)
+            keyfile (str): The PEM private key of the certificate (default: None - the key is read from certfile)
+            limiter (RateLimiter): The rate limits per user and per connection (default: None - commands are not limited)
+            compact_users (bool): Keep the users in a compact UserTable, for databases of millions of users (default: False)
+            journal (str): The file the commands of all sessions are appended to, see replay.py (default: None - commands are not recorded)
+            storage_roots (list): The directories or mount points the users' directories are spread over (default: None - all users are below root/usr)
+            retired_roots (list): Storage roots the 'rebalance' command moves all users out of (default: None)
+            admins (list): The usernames allowed to run admin commands, their accounts must be added to the database
+                by the operator as they can't be registered (default: None - nobody)
 
         Raises:
             IOException: If the server cannot be created
 
         """
 
-        super().__init__(socket.AF_INET, socket.SOCK_STREAM)
-        self.setsockopt(
-            socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # On restart the listening socket is inherited from the previous process, so no connection is refused
+        listen_fd = os.environ.pop(LISTEN_FD, None)
+
+        if listen_fd is not None:
+            super().__init__(fileno=int(listen_fd))
+            print(f"Server took over listening on http://{host}:{port}")
+        else:
+            super().__init__(socket.AF_INET, socket.SOCK_STREAM)
+            self.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+            self.bind((host, port))
+            self.listen(5)
+            print(f"Server listening on http://{host}:{port}")
 
-        self.bind((host, port))
-        self.listen(5)
-        print(f"Server listening on http://{host}:{port}")
+        self.settimeout(ACCEPT_INTERVAL)
         
-        self.DB = Users()
+        # The database loads in the background so connections are accepted right away,
+        # register and login wait for it to finish loading
+        self.DB = Users(background=True, compact=compact_users)
+        # Hard links can't cross filesystems, so with several storage roots each root has its own blob store
+        self.storage = Storage(storage_roots, retired_roots, dedup) if storage_roots else None
+        self.blob_store = BlobStore(gc_interval=GC_INTERVAL) if dedup and self.storage is None else None
+        self.compression = compression
+        self.limiter = limiter
+        self.journal = Journal(journal) if journal is not None else None
+        # Always available, so a slow command can be profiled without restarting the server
+        self.profiler = Profiler()
+        # Commands are lowercased, so usernames are compared lowercased
+        self.admins = frozenset(name.lower() for name in admins or ())
+
+        # TLS 1.3 session tickets are issued by default, so reconnecting clients can resume their session
+        self.tls_context = None
+        if certfile is not None:
+            # Imported only when needed, ssl takes longer to import than the rest of the server
+            import ssl
+
+            self.tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.tls_context.minimum_version = ssl.TLSVersion.TLSv1_2
+            self.tls_context.load_cert_chain(certfile, keyfile)
+
+        self.running = True
+        self.restarting = False
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+        # Signals can only be handled by the main thread
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.shutdown_handler)
+            signal.signal(signal.SIGINT, self.shutdown_handler)
+            signal.signal(signal.SIGHUP, self.restart_handler)
 
         self.start()
 
     def start(self):
         """Start the server and listen for connections
-           Create a new thread for each client connection and create a new instance of the ClientHandler class
+           Create a new thread for each client connection that serves it
+           Once the server stops, the connected sessions are drained before returning
         
         Raises:
             IOException: If the client gets disconnected
         """
 
 
-        while True:
+        while self.running:
             try:
                 conn, addr = self.accept()
+            except socket.timeout:
+                continue
+            except Exception as e:
+                print (e)
+                break
+
+            try:
                 conn.setblocking(True)
+                # Responses are single small writes, don't hold them back waiting for the client's ACK
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 print("Client connected:" + addr[0])
 
-                new_thread = threading.Thread(target=ClientHandler(conn, self.DB).handle, args=[
+                new_thread = threading.Thread(target=self.serve, args=[
                     conn, addr], daemon=True)
 
                 new_thread.start()
             except Exception as e:
                 print (e)
-                break
 
         self.close()
 
+        # After a hand over the sessions may end on their own, as they can't move to the new process
+        self.drain(RESTART_TIMEOUT if self.restarting else 0)
+
+        if self.journal is not None:
+            self.journal.close()
+
+    def shutdown_handler(self, signum, frame):
+        """Stop accepting connections on SIGTERM or SIGINT, the sessions are then drained by start
+
+        Args:
+            signum (int): The signal received
+            frame (frame): The frame interrupted by the signal
+        """
+        print("Shutting down")
+        self.running = False
+
+    def restart_handler(self, signum, frame):
+        """Hand the listening socket to a new server process on SIGHUP and stop accepting connections
+           The new process accepts new connections right away, while this one keeps serving its sessions
+
+        Args:
+            signum (int): The signal received
+            frame (frame): The frame interrupted by the signal
+        """
+        import subprocess
+
+        print("Restarting")
+
+        # Only the new process saves the users database from now on, before it starts loading it
+        self.DB.freeze()
+
+        env = dict(os.environ)
+        env[LISTEN_FD] = str(self.fileno())
+        subprocess.Popen([sys.executable] + sys.argv, pass_fds=[self.fileno()], env=env)
+
+        self.restarting = True
+        self.running = False
+
+    def drain(self, wait_for_clients=0):
+        """Wait for the connected sessions to end
+
+        Args:
+            wait_for_clients (float): Seconds sessions may continue before they are asked to stop (default: 0)
+        """
+        deadline = time.monotonic() + wait_for_clients
+        while self.sessions and time.monotonic() < deadline:
+            time.sleep(ACCEPT_INTERVAL)
+
+        with self.sessions_lock:
+            sessions = list(self.sessions.items())
+
+        if sessions:
+            print(f"Draining {len(sessions)} sessions")
+
+        # Each session finishes its command in progress and ends
+        for _, handler in sessions:
+            handler.stop()
+
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        for thread, _ in sessions:
+            thread.join(max(0, deadline - time.monotonic()))
+
+    def serve(self, conn, addr):
+        """Serve a client connection in its own thread
+           The TLS handshake is done here rather than in the accept loop, so slow handshakes never delay new connections
+
+        Args:
+            conn (socket): The socket connection to the client
+            addr (tuple): The address of the client
+        """
+        if self.tls_context is not None:
+            try:
+                conn.settimeout(HANDSHAKE_TIMEOUT)
+                conn = self.tls_context.wrap_socket(conn, server_side=True)
+                conn.settimeout(None)
+            except OSError as e:
+                print("TLS handshake failed:" + addr[0] + " " + str(e))
+                conn.close()
+                return
+
+        handler = ClientHandler(conn, self.DB, self.blob_store, self.compression, self.limiter, self.journal,
+                                self.storage, self.profiler, self.admins)
+
+        with self.sessions_lock:
+            self.sessions[threading.current_thread()] = handler
+
+        try:
+            handler.handle(conn, addr)
+        finally:
+            with self.sessions_lock:
+                del self.sessions[threading.current_thread()]
+
 
 # Run main
+def main(argv=None):
+    """
+        Start the server with the options given on the command line
+        A restart on SIGHUP runs the same command line, so the new process keeps every option
+
+    Args:
+        argv (list): The command line arguments (default: None - sys.argv)
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the users' files")
+    parser.add_argument("--host", default="localhost", help="The hostname to listen on (default: localhost)")
+    parser.add_argument("--port", type=int, default=8080, help="The port to listen on (default: 8080)")
+    parser.add_argument("--dedup", action="store_true", help="Store identical files only once")
+    parser.add_argument("--compression", choices=["zlib", "lzma"], help="Compress stored files with this codec")
+    parser.add_argument("--certfile", help="Serve TLS with this PEM certificate chain")
+    parser.add_argument("--keyfile", help="The PEM private key of the certificate, if not in certfile")
+    parser.add_argument("--rate-limit", action="store_true", help="Limit the commands and bytes of every user and connection")
+    parser.add_argument("--compact-users", action="store_true", help="Keep the users in a compact table, for millions of users")
+    parser.add_argument("--journal", help="Append the commands of all sessions to this file, see replay.py")
+    parser.add_argument("--storage-root", action="append", dest="storage_roots", metavar="DIRECTORY",
+                        help="Spread the users' directories over this root, can be repeated")
+    parser.add_argument("--retired-root", action="append", dest="retired_roots", metavar="DIRECTORY",
+                        help="Move all users out of this root on 'rebalance', can be repeated")
+    parser.add_argument("--admin", action="append", dest="admins", metavar="USERNAME",
+                        help="Allow this user to run admin commands, can be repeated")
+    args = parser.parse_args(argv)
+
+    limiter = None
+    if args.rate_limit:
+        from RateLimiter import RateLimiter
+
+        limiter = RateLimiter()
+
+    Server(args.host, args.port, args.dedup, args.compression, args.certfile, args.keyfile, limiter,
+           args.compact_users, args.journal, args.storage_roots, args.retired_roots, args.admins)
+
+
 if __name__ == "__main__":
-    Server("localhost", 8080)
+    main()